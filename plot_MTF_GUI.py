@@ -1,4 +1,7 @@
+import os
 import wx
+import matplotlib
+matplotlib.use('wxAgg')  # before pyplot is imported by process_THF_file
 import process_THF_file  # the custom module for this project
 
 mytitle = 'Plot MTF'
@@ -10,7 +13,7 @@ class MyFrame(wx.Frame):
     def __init__(self, parent):
         wx.Frame.__init__(
             self, None,
-            pos=wx.DefaultPosition, size=wx.Size(800, 550),
+            pos=wx.DefaultPosition, size=wx.DefaultSize,
             style=wx.MINIMIZE_BOX | wx.CLOSE_BOX | wx.SYSTEM_MENU |
             wx.CAPTION | wx.CLIP_CHILDREN,
             title=mytitle + ' v' + version_number)
@@ -25,6 +28,11 @@ class MyPanel(wx.Panel):
 
         box_width = 400
 
+        # The figure from the last run; kept so that the frequencies, the
+        # spec lines, and the average option can be changed in place
+        self.mtf_figure = None
+        self.mtf_settings = None
+
         # Create some sizers
         mainSizer = wx.BoxSizer(wx.VERTICAL)
         hSizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -69,7 +77,9 @@ class MyPanel(wx.Panel):
         self.freqs_text = wx.StaticText(
             self, label='Frequencies, separated by commas (i.e. 5, 10, 15)')
         grid.Add(self.freqs_text, pos=(row_count, 0))
-        self.freqs = wx.TextCtrl(self, value='', size=(box_width, -1))
+        self.freqs = wx.TextCtrl(
+            self, value='', size=(box_width, -1), style=wx.TE_PROCESS_ENTER)
+        self.Bind(wx.EVT_TEXT_ENTER, self.OnUpdate, self.freqs)
         grid.Add(self.freqs, pos=(row_count, 1))
 
         # ~~~~~~~~~~
@@ -93,9 +103,20 @@ class MyPanel(wx.Panel):
         self.spec_lines_text = wx.StaticText(
             self, label='Spec lines, separated by commas (i.e. 25, 50, 75)')
         grid.Add(self.spec_lines_text, pos=(row_count, 0))
-        self.spec_lines = wx.TextCtrl(self, value='', size=(box_width, -1))
+        self.spec_lines = wx.TextCtrl(
+            self, value='', size=(box_width, -1), style=wx.TE_PROCESS_ENTER)
+        self.Bind(wx.EVT_TEXT_ENTER, self.OnUpdate, self.spec_lines)
         grid.Add(self.spec_lines, pos=(row_count, 1))
 
+        # The pass/fail spec rules
+        row_count += 1
+        self.spec_rules_text = wx.StaticText(
+            self, label='Pass/fail rules, separated by semicolons\n' +
+            '(i.e. avg 52 40 -20 20; horz 104 25)')
+        grid.Add(self.spec_rules_text, pos=(row_count, 0))
+        self.spec_rules = wx.TextCtrl(self, value='', size=(box_width, -1))
+        grid.Add(self.spec_rules, pos=(row_count, 1))
+
         # Number of plot rows
         row_count += 1
         self.plots_down_text = wx.StaticText(
@@ -104,6 +125,24 @@ class MyPanel(wx.Panel):
         self.plots_down = wx.TextCtrl(self, value='', size=(box_width, -1))
         grid.Add(self.plots_down, pos=(row_count, 1))
 
+        # Defocus offsets for the MTF vs. frequency curves
+        row_count += 1
+        self.offsets_text = wx.StaticText(
+            self, label='Offsets from best focus (um), separated by ' +
+            'commas\n(i.e. -20, 0, 20); default is best focus only')
+        grid.Add(self.offsets_text, pos=(row_count, 0))
+        self.offsets = wx.TextCtrl(self, value='', size=(box_width, -1))
+        grid.Add(self.offsets, pos=(row_count, 1))
+
+        # Number of worker processes for reading the files
+        row_count += 1
+        self.workers_text = wx.StaticText(
+            self, label='Worker processes for reading the files; default ' +
+            'is none\n(files are read one at a time)')
+        grid.Add(self.workers_text, pos=(row_count, 0))
+        self.workers = wx.TextCtrl(self, value='', size=(box_width, -1))
+        grid.Add(self.workers, pos=(row_count, 1))
+
 #        # Option for saving the data to an external file
 #        row_count += 1
 #        self.select_data_save_text = wx.StaticText(
@@ -127,8 +166,45 @@ class MyPanel(wx.Panel):
             self, label='Plot average MTF; default is separate horz and vert')
         grid.Add(self.plot_avg_text, pos=(row_count, 0))
         self.plot_avg = wx.CheckBox(self)
+        self.Bind(wx.EVT_CHECKBOX, self.OnUpdate, self.plot_avg)
         grid.Add(self.plot_avg, pos=(row_count, 1))
 
+        # Checkbox to plot groups of symmetric field positions
+        row_count += 1
+        self.field_groups_text = wx.StaticText(
+            self, label='Group symmetric field positions (i.e. +14 and ' +
+            '-14 degrees)')
+        grid.Add(self.field_groups_text, pos=(row_count, 0))
+        self.field_groups = wx.CheckBox(self)
+        grid.Add(self.field_groups, pos=(row_count, 1))
+
+        # Checkbox to plot the full MTF tables as images
+        row_count += 1
+        self.heatmaps_text = wx.StaticText(
+            self, label='Plot full MTF tables as images (frequencies not ' +
+            'needed)')
+        grid.Add(self.heatmaps_text, pos=(row_count, 0))
+        self.heatmaps = wx.CheckBox(self)
+        grid.Add(self.heatmaps, pos=(row_count, 1))
+
+        # Checkbox to plot MTF vs. frequency at best focus
+        row_count += 1
+        self.best_focus_text = wx.StaticText(
+            self, label='Plot MTF vs. frequency at best focus (frequencies ' +
+            'not needed)')
+        grid.Add(self.best_focus_text, pos=(row_count, 0))
+        self.best_focus = wx.CheckBox(self)
+        grid.Add(self.best_focus, pos=(row_count, 1))
+
+        # Checkbox to plot files with the same MTF data only once
+        row_count += 1
+        self.skip_duplicates_text = wx.StaticText(
+            self, label='Skip duplicate files (same MTF data under another ' +
+            'name)')
+        grid.Add(self.skip_duplicates_text, pos=(row_count, 0))
+        self.skip_duplicates = wx.CheckBox(self)
+        grid.Add(self.skip_duplicates, pos=(row_count, 1))
+
         # ~~~~~~~~~~
 
         # "Run!" button
@@ -144,28 +220,122 @@ class MyPanel(wx.Panel):
         mainSizer.Add(hSizer, 0, wx.ALL, 5)
         self.SetSizerAndFit(mainSizer)
 
-    ''' When "Run!" is clicked, then run the "plot_all" function from the
-    "plot_MTF" module. '''
-    def OnClick(self, event):
-        # Mandatory entries
+    ''' Checks the mandatory entries; returns True if they are all OK. '''
+    def CheckEntries(self):
         if self.select_dir.GetPath() == '':
             wx.MessageBox('Please select a directory.', 'Error')
-            return
+            return False
 
         if self.freqs.GetValue() == '':
             wx.MessageBox('Please enter at least one frequency.', 'Error')
-            return
+            return False
 
         if len(self.freqs.GetValue().split(',')) > 6:
             wx.MessageBox('Cannot use more than six spatial frequencies.',
                           'Error')
+            return False
+
+        return True
+
+    ''' Returns True if the figure from the last run is still open and
+    shows the same files in the same layout. '''
+    def FigureIsCurrent(self):
+        return (
+            self.mtf_figure is not None and
+            process_THF_file.plt.fignum_exists(
+                self.mtf_figure.figure.number) and
+            self.mtf_settings == (
+                self.select_dir.GetPath(),
+                self.plots_down.GetValue(),
+                self.plot_title.GetValue(),
+                self.same_plot.GetValue(),
+                self.skip_duplicates.GetValue()))
+
+    ''' When "Run!" is clicked, then read and plot all the files in the
+    directory again (e.g. after files were added), replacing the last
+    figure.  Enter in the text fields and the average checkbox update the
+    last figure in place instead; see OnUpdate. '''
+    def OnClick(self, event):
+        try:
+            self.Plot()
+        except ValueError as error:  # e.g. no files that can be plotted
+            wx.MessageBox(str(error), 'Error')
+
+    ''' Returns the number of worker processes, or None if the field is
+    empty. '''
+    def Workers(self):
+        value = self.workers.GetValue().strip()
+        if value == '':
+            return None
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError('The number of worker processes must be a '
+                             'positive whole number.')
+        return int(value)
+
+    ''' Runs the plot that is selected with the checkboxes. '''
+    def Plot(self):
+        workers = self.Workers()
+
+        # The full-table images only need a directory
+        if self.heatmaps.GetValue():
+            if self.select_dir.GetPath() == '':
+                wx.MessageBox('Please select a directory.', 'Error')
+                return
+
+            self.ShowSkipped(process_THF_file.plot_MTF_heatmaps(
+                self.select_dir.GetPath(),
+                self.plots_down.GetValue(),
+                self.plot_title.GetValue(),
+                self.spec_lines.GetValue(),
+                True,  # always maximize the plot
+                workers=workers))
+            return
+
+        # The MTF vs. frequency curves only need a directory too
+        if self.best_focus.GetValue():
+            if self.select_dir.GetPath() == '':
+                wx.MessageBox('Please select a directory.', 'Error')
+                return
+
+            self.ShowSkipped(process_THF_file.plot_best_focus_curves(
+                self.select_dir.GetPath(),
+                self.plots_down.GetValue(),
+                self.plot_title.GetValue(),
+                self.offsets.GetValue(),
+                self.spec_lines.GetValue(),
+                self.plot_avg.GetValue(),
+                ['b', 'r', 'g', 'c', 'y', 'k'],
+                True,  # always maximize the plot
+                skip_duplicates=self.skip_duplicates.GetValue(),
+                workers=workers))
+            return
+
+        # Mandatory entries
+        if not self.CheckEntries():
             return
 
         colors = ['b', 'r', 'g', 'c', 'y', 'k']
         maximize_plot = True  # always maximize the plot
 
+        # One panel per group of field positions
+        if self.field_groups.GetValue():
+            self.ShowSkipped(process_THF_file.plot_field_groups(
+                self.select_dir.GetPath(),
+                self.plots_down.GetValue(),
+                self.plot_title.GetValue(),
+                self.freqs.GetValue(),
+                self.spec_lines.GetValue(),
+                colors,
+                maximize_plot,
+                skip_duplicates=self.skip_duplicates.GetValue(),
+                workers=workers))
+            return
+
+        if self.FigureIsCurrent():
+            process_THF_file.plt.close(self.mtf_figure.figure)
+
         # Run the plotting function
-        process_THF_file.plot_all(
+        self.mtf_figure = process_THF_file.MTFFigure(
             self.select_dir.GetPath(),
             self.plots_down.GetValue(),
             self.plot_title.GetValue(),
@@ -174,11 +344,79 @@ class MyPanel(wx.Panel):
             self.plot_avg.GetValue(),
             self.same_plot.GetValue(),
             colors,
-            maximize_plot)
+            maximize_plot,
+            self.skip_duplicates.GetValue(),
+            workers=workers)
+        self.mtf_settings = (
+            self.select_dir.GetPath(),
+            self.plots_down.GetValue(),
+            self.plot_title.GetValue(),
+            self.same_plot.GetValue(),
+            self.skip_duplicates.GetValue())
+        self.ShowSkipped(self.mtf_figure.skipped)
+        self.CheckSpecs()
+
+    ''' Lists the files that were skipped (unreadable files and duplicates),
+    since the GUI may run without a console to print them to. '''
+    def ShowSkipped(self, skipped):
+        if not skipped:
+            return
 
+        lines = [os.path.basename(path) + ': ' + reason
+                 for path, reason in skipped[:20]]
+        if len(skipped) > 20:
+            lines.append('... and %d more' % (len(skipped) - 20))
+        wx.MessageBox(
+            '%d file(s) were skipped:\n\n%s' % (
+                len(skipped), '\n'.join(lines)),
+            'Skipped files')
+
+    ''' If there are any pass/fail rules, then evaluate them on the plotted
+    files and show the lot yield and the failing files. '''
+    def CheckSpecs(self):
+        if self.spec_rules.GetValue().strip() == '':
+            return
+
+        try:
+            rules = process_THF_file.parse_spec_rules(
+                self.spec_rules.GetValue())
+        except ValueError as error:
+            wx.MessageBox(str(error), 'Error')
+            return
 
-app = wx.App(False)
-frame = MyFrame(None)
-panel = MyPanel(frame)
-frame.Show()
-app.MainLoop()
+        # Reuse the data that was already read for the plot
+        stack = process_THF_file.stack_records(self.mtf_figure.records)
+        verdicts, passed, lot_yield = process_THF_file.evaluate_specs(
+            stack, rules)
+
+        failed = [
+            os.path.basename(path)
+            for path, file_passed in zip(stack.paths, passed)
+            if not file_passed]
+        wx.MessageBox(
+            'Lot yield: %.1f %% (%d of %d files pass)\n\nFailing files:\n%s'
+            % (100*lot_yield, passed.sum(), len(passed),
+               '\n'.join(failed) or 'none'),
+            'Pass/fail results')
+
+    ''' When the frequencies, the spec lines, or the average option change,
+    then update the open figure in place (without re-reading the files). '''
+    def OnUpdate(self, event):
+        if not self.FigureIsCurrent() or not self.CheckEntries():
+            return
+
+        self.mtf_figure.update(
+            self.freqs.GetValue(),
+            self.spec_lines.GetValue(),
+            self.plot_avg.GetValue())
+
+
+# The worker processes import this module too (on Windows), so only the
+# main process opens the window
+if __name__ == '__main__':
+    app = wx.App(False)
+    frame = MyFrame(None)
+    panel = MyPanel(frame)
+    frame.SetClientSize(panel.GetBestSize())  # fit the frame to all the rows
+    frame.Show()
+    app.MainLoop()
@@ -1,25 +1,283 @@
 import numpy as np
 import os
+import io
+import re
+import json
+import hashlib
+import tarfile
+import zipfile
+import threading
+import multiprocessing
 import matplotlib
-matplotlib.use('wxAgg')
 import matplotlib.pyplot as plt
 import time
+from collections import Counter, namedtuple
 from datetime import datetime
 
 t0 = time.clock()
 
+# Section headers in a ``.thf`` file and the record field each one fills
+_SECTION_HEADERS = {
+    'Horizontal Freq (lp/mm)  MTF @': 'horz',
+    'Vertical Freq (lp/mm)  MTF @': 'vert',
+    'Defocus Intensity Data: Horiz\tVert': 'intensity',
+    'Defocus Position': 'defocus',
+}
+
+# One parsed ``.thf`` file, as yielded by ``iter_thf``
+THFRecord = namedtuple(
+    'THFRecord', ['path', 'defocus', 'horz', 'vert', 'intensity', 'header'])
+
+# Many parsed ``.thf`` files stacked into arrays, as returned by
+# ``stack_records`` and ``load_MTF_store``
+THFStack = namedtuple(
+    'THFStack',
+    ['paths', 'freqs', 'defocus', 'horz', 'vert', 'intensity', 'headers'])
+
+# One pass/fail rule, as used by ``evaluate_specs``
+SpecRule = namedtuple(
+    'SpecRule',
+    ['orientation', 'freq', 'min_MTF', 'defocus_min', 'defocus_max'])
+
+# Differences between a test lot and a reference lot, from ``compare_lots``
+LotComparison = namedtuple(
+    'LotComparison',
+    ['pairs', 'freqs', 'defocus', 'horz', 'vert', 'unmatched'])
+
+# Statistics of groups of symmetric field positions, from
+# ``field_group_stats``
+FieldGroups = namedtuple(
+    'FieldGroups',
+    ['angles', 'paths', 'freqs', 'defocus', 'mean', 'asymmetry', 'worst'])
+
+# MTF vs. spatial frequency at and around best focus, from
+# ``best_focus_curves``
+FocusCurves = namedtuple(
+    'FocusCurves', ['paths', 'freqs', 'offsets', 'best_focus', 'MTF'])
+
+
+
+class NoTHFFilesError(ValueError):
+    """
+    Raised when there is no ``.thf`` file that can be read or plotted (e.g.
+    every file in the directory was skipped).  It is a ValueError, so code
+    that catches ValueError for bad input catches it too.
+    """
+
+
+# Finds a signed field angle in a file name, e.g. "+14 degrees.thf"
+_FIELD_ANGLE_PATTERN = r'([+-]?\d+(?:\.\d+)?)\s*deg'
+
+# Name of the file that marks a directory as an MTF store
+_STORE_MANIFEST = 'MTF_store.json'
+
+# Opened MTF stores, and the index of each path in them, by store directory
+_store_cache = {}  # store dir -> (manifest stamp, THFStack, name -> idx)
+
+# Matches the end of an archive name inside a member path such as
+# "lot.zip/sub/a.thf"
+_ARCHIVE_IN_PATH = re.compile(r'\.(zip|tar|tar\.gz|tgz)(?=[\\/])', re.I)
+
+# First bytes of every through-focus MTF file, and the smallest size that a
+# complete file can have
+_THF_SIGNATURE = b'THRUFOCUS'
+_MIN_THF_SIZE = 1024
+
+# The most recently opened zip archive, kept open so that reading many
+# members does not re-read the archive's directory every time
+_zip_cache = {}
+
+# A window of ``.thf`` members of the most recently read tar archive.  A
+# compressed tar file is one stream, so reading a single member means
+# decompressing everything before it; the members after it (up to
+# ``_TAR_WINDOW_SIZE`` bytes) are kept too, since they are usually read next.
+# (``iter_thf`` and ``stack_THF_files`` stream tar archives instead.)
+_tar_cache = {}
+_TAR_WINDOW_SIZE = 32*2**20
+
+# Held while using the two caches above, so that threads (e.g. the handlers
+# of ``serve_THF_files``) do not close or swap an archive in use by another
+_archive_lock = threading.RLock()
+
+# The shared-memory stack arrays, in a worker process of ``_stack_shared``
+_shared_worker_arrays = {}
+
+
+def _split_archive_path(path):
+    """
+    Splits a path to a member of a ``.zip`` or ``.tar(.gz)`` archive into the
+    archive path and the member name.
+
+    Parameters
+    ==========
+    path : string
+        e.g. ``C:/data/lot.zip/sub/a.thf``
+
+    Returns
+    =======
+    archive_path, member_name : strings
+        e.g. ``C:/data/lot.zip`` and ``sub/a.thf``.  ``archive_path`` is None
+        if "path" is not inside an archive.
+    """
+    if not os.path.exists(path):
+        for match in _ARCHIVE_IN_PATH.finditer(path):
+            if os.path.isfile(path[:match.end()]):
+                member_name = path[match.end() + 1:].replace('\\', '/')
+                return path[:match.end()], member_name
+
+    return None, path
+
+
+def _open_zip(archive_path):
+    """
+    Returns an open ``zipfile.ZipFile``, reusing the last one if it is the
+    same archive.  Hold ``_archive_lock`` while using it.
+    """
+    if archive_path not in _zip_cache:
+        for archive in _zip_cache.values():
+            archive.close()
+        _zip_cache.clear()
+        _zip_cache[archive_path] = zipfile.ZipFile(archive_path)
+
+    return _zip_cache[archive_path]
+
+
+def _read_tar_member(archive_path, member_name):
+    """
+    Returns the contents of one ``.thf`` member of a tar archive, from the
+    window of members kept in ``_tar_cache`` if it is there.  Otherwise the
+    archive is read up to that member, and it and the members after it are
+    kept in place of the last window.
+    """
+    stamp = os.stat(archive_path)
+    stamp = (archive_path, stamp.st_mtime, stamp.st_size)
+    with _archive_lock:
+        if _tar_cache.get('stamp') != stamp or \
+                member_name not in _tar_cache['members']:
+            members = {}
+            size = 0
+            with tarfile.open(archive_path) as archive:
+                for member in archive:
+                    if not member.isfile() or \
+                            not member.name.lower().endswith('.thf'):
+                        continue
+                    if not members and member.name != member_name:
+                        continue  # before the requested member
+                    if size >= _TAR_WINDOW_SIZE:
+                        break
+                    members[member.name] = archive.extractfile(member).read()
+                    size += len(members[member.name])
+            _tar_cache.clear()
+            _tar_cache.update(stamp=stamp, members=members)
+
+        if member_name not in _tar_cache['members']:
+            raise IOError('No member %s in %s' % (member_name, archive_path))
+        return _tar_cache['members'][member_name]
+
+
+def _open_THF(path):
+    """
+    Opens a ``.thf`` file for reading line by line.  "path" can be a normal
+    file or a member of a ``.zip`` or ``.tar(.gz)`` archive (e.g.
+    ``lot.zip/a.thf``); archive members are read into memory, never
+    extracted to disk.
+
+    Returns
+    =======
+    infile : file-like object
+        to be used in a ``with`` statement
+    """
+    if _split_archive_path(path)[0] is None:
+        return open(path)
+
+    return io.StringIO(_read_THF_bytes(path).decode('latin-1'))
+
+
+def _read_THF_bytes(path):
+    """
+    Returns the raw contents of a ``.thf`` file, which can be a normal file
+    or a member of a ``.zip`` or ``.tar(.gz)`` archive.
+    """
+    archive_path, member_name = _split_archive_path(path)
+    if archive_path is None:
+        with open(path, 'rb') as infile:
+            return infile.read()
+
+    if zipfile.is_zipfile(archive_path):
+        with _archive_lock:
+            return _open_zip(archive_path).read(member_name)
+
+    return _read_tar_member(archive_path, member_name)
+
+
+def hash_THF_file(path, numeric_only=False):
+    """
+    Returns a hash of the contents of a ``.thf`` file, e.g. as a cache key
+    that stays the same when the file is copied or renamed.
+
+    Parameters
+    ==========
+    path : string
+        through-focus MTF data file ending in ``.thf`` or ``.THF``, a member
+        of an archive, or a file in an MTF store (for which the stored
+        arrays are hashed)
+
+    numeric_only : boolean (optional)
+        If true, then only the numeric sections are hashed and the header
+        (test date and time, operator, etc.) is ignored, so that the same
+        measurement saved twice gets the same hash.
+
+    Returns
+    =======
+    digest : string
+        hexadecimal SHA-1 digest
+
+    See Also
+    ========
+    iter_unique_paths
+    """
+    if _split_store_path(path)[0] is not None:
+        return _hash_record(read_THF_file(path))
+
+    return _hash_THF_data(_read_THF_bytes(path), numeric_only)
+
+
+def _hash_THF_data(data, numeric_only=False):
+    """
+    Hashes the raw contents of a ``.thf`` file; see ``hash_THF_file``.
+    """
+    if numeric_only:
+        # The header is everything before the first numeric section
+        starts = [data.find(header.encode('latin-1'))
+                  for header in _SECTION_HEADERS]
+        starts = [start for start in starts if start >= 0]
+        if starts:
+            data = data[min(starts):]
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def _hash_record(record):
+    """
+    Hashes the numeric arrays of a parsed record, e.g. from an MTF store.
+    """
+    digest = hashlib.sha1()
+    for array in (record.defocus, record.horz, record.vert,
+                  record.intensity):
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
 def pull_horz_MTF(path):
     """
     Returns a Numpy array of the all the horizontal data in the through-focus
     MTF data file at "path".
 
-    From stackoverflow.com/questions/18865058/extract-values-between-two-
-         strings-in-a-text-file-using-python
-
     Parameters
     ==========
     path : string
-        through-focus MTF data file ending in ``.thf`` or ``.THF``
+        through-focus MTF data file ending in ``.thf`` or ``.THF``, a member
+        of an archive, or a file in an MTF store (see ``write_MTF_store``)
 
     Returns
     =======
@@ -34,30 +292,11 @@ def pull_horz_MTF(path):
     There is a corresponding function (``pull_vert_MTF``) that pulls the
     vertical MTF data.
 
-    Code from stackoverflow.com/questions/18865058/extract-values-between-two-
-    strings-in-a-text-file-using-python
-
     See Also
     ========
-    pull_vert_MTF
+    pull_vert_MTF, read_THF_file
     """
-    horz = []
-
-    with open(path) as infile:
-        copy = False
-        for line in infile:
-            if line.strip() == "Horizontal Freq (lp/mm)  MTF @":
-                copy = True
-            elif line.strip() == "Vertical Freq (lp/mm)  MTF @":
-                copy = False
-            elif copy:
-                horz.append(line.strip().split('\t'))
-
-    # Delete first and last line from "horz", since those are empty lines
-    # +++ WORK -- a more robust method is needed +++
-    horz = horz[1:len(horz)-1]
-
-    return np.asarray(horz).astype(float)
+    return read_THF_file(path).horz
 
 
 def pull_vert_MTF(path):
@@ -68,7 +307,8 @@ def pull_vert_MTF(path):
     Parameters
     ==========
     path : string
-        through-focus MTF data file ending in ``.thf`` or ``.THF``
+        through-focus MTF data file ending in ``.thf`` or ``.THF``, a member
+        of an archive, or a file in an MTF store (see ``write_MTF_store``)
 
     Returns
     =======
@@ -85,21 +325,9 @@ def pull_vert_MTF(path):
 
     See Also
     ========
-    pull_horz_MTF
+    pull_horz_MTF, read_THF_file
     """
-    vert = []
-
-    with open(path) as infile:
-        copy = False
-        for line in infile:
-            if line.strip() == "Vertical Freq (lp/mm)  MTF @":
-                copy = True
-            elif line.strip() == "Defocus Intensity Data: Horiz	Vert":
-                copy = False
-            elif copy:
-                vert.append(line.strip().split('\t'))
-
-    return np.asarray(vert).astype(float)
+    return read_THF_file(path).vert
 
 
 def pull_MTF_data(path, desired_freqs):
@@ -135,10 +363,14 @@ def pull_MTF_data(path, desired_freqs):
 
         :todo: Throw an error if the user inputs a freq that isn't in the data.
     """
-    # Pull all data
-    horz = pull_horz_MTF(path)
-    vert = pull_vert_MTF(path)
+    return _MTF_rows(pull_horz_MTF(path), pull_vert_MTF(path), desired_freqs)
 
+
+def _MTF_rows(horz, vert, desired_freqs):
+    """
+    Averages the horizontal and vertical data of one file and slices out the
+    rows at the desired frequencies; see ``pull_MTF_data``.
+    """
     # Average horz and vert; this is an array of *all* the freqs in the file
     average_MTF = np.add(horz, vert)/2
 
@@ -161,28 +393,497 @@ def pull_defocus(path):
     Parameters
     ==========
     path : string
-        through-focus MTF data file ending in ``.thf`` or ``.THF``
+        through-focus MTF data file ending in ``.thf`` or ``.THF``, a member
+        of an archive, or a file in an MTF store (see ``write_MTF_store``)
 
     Returns
     =======
     defocus : array of floats
         The defocus positions in microns along the :math:`z` axis as a
-        numpy.ndarray of floats
+        (planes x 1) numpy.ndarray of floats
+    """
+    return read_THF_file(path).defocus.reshape(-1, 1)
+
+
+def _parse_THF_lines(lines):
+    """
+    Splits the lines of a ``.thf`` file into its numeric sections in a single
+    pass.
+
+    Parameters
+    ==========
+    lines : iterable of strings
+        lines of a through-focus MTF data file (e.g. an open file object)
+
+    Returns
+    =======
+    sections : dict
+        Maps each name in ``_SECTION_HEADERS`` to a list of rows, where each
+        row is a list of floats.  ``sections['header']`` is a dict of the
+        ``name: value`` fields above the first section (e.g.
+        ``'Field Angle'``).
+
+    Notes
+    =====
+    A section starts at its header line and ends at the first line that is
+    neither blank nor numeric (i.e. the next header).  Blank lines inside a
+    section are skipped, so the repeated "Horizontal Freq (lp/mm)  MTF @"
+    header does not need special handling.
+    """
+    sections = dict((name, []) for name in _SECTION_HEADERS.values())
+    header = sections['header'] = {}
+    in_header = True
+    current = None
+
+    for line in lines:
+        stripped = line.strip()
+        if stripped in _SECTION_HEADERS:
+            current = _SECTION_HEADERS[stripped]
+            in_header = False
+        elif in_header and ':' in stripped:
+            name, value = stripped.split(':', 1)
+            header[name.strip()] = value.strip()
+        elif stripped == '' or current is None:
+            continue
+        else:
+            try:
+                sections[current].append(
+                    [float(value) for value in stripped.split('\t')])
+            except ValueError:  # any other header ends the current section
+                current = None
+
+    return sections
+
+
+def read_THF_file(path, freqs=None):
+    """
+    Reads the defocus positions and the horizontal and vertical MTF data of
+    one ``.thf`` file in a single pass.
+
+    Parameters
+    ==========
+    path : string
+        through-focus MTF data file ending in ``.thf`` or ``.THF``; can be a
+        member of a ``.zip`` or ``.tar(.gz)`` archive, e.g. ``lot.zip/a.thf``
+
+    freqs : 1D list of floats (optional)
+        If given, only the MTF rows at these spatial frequencies are kept.
+        Otherwise the full tables are kept.
+
+    Returns
+    =======
+    record : THFRecord
+        ``(path, defocus, horz, vert, intensity, header)``, where ``defocus``
+        is a 1D array of the defocus positions, ``horz`` and ``vert`` are laid
+        out like the output of ``pull_horz_MTF`` and ``pull_vert_MTF`` (the
+        first column is the spatial frequency), ``intensity`` is the
+        (planes x 2) horizontal and vertical defocus intensity data, and
+        ``header`` is a dict of the header fields (e.g. ``'Lens ID'``).
+
+    See Also
+    ========
+    iter_thf, pull_horz_MTF, pull_vert_MTF, pull_defocus,
+    pull_defocus_intensity
+    """
+    store_dir, name = _split_store_path(path)
+    if store_dir is not None:
+        stack = load_MTF_store(store_dir)
+        idx = _store_cache[store_dir][2][name]
+        return _store_record(stack, idx, freqs)
+
+    with _open_THF(path) as infile:
+        return _make_record(path, infile, freqs)
+
+
+def _make_record(path, lines, freqs=None):
     """
-    defocus = []
+    Parses the lines of one ``.thf`` file into a ``THFRecord``.  See
+    ``read_THF_file``.
+    """
+    sections = _parse_THF_lines(lines)
+
+    # Every numeric section must be there, with rows of equal length
+    for header, name in _SECTION_HEADERS.items():
+        rows = sections[name]
+        if not rows or len(set(len(row) for row in rows)) != 1:
+            raise ValueError(
+                'The "%s" section is missing or truncated in %s.' %
+                (header.replace('\t', ' '), path))
+
+    defocus = np.asarray(sections['defocus']).ravel()
+    horz = np.asarray(sections['horz'])
+    vert = np.asarray(sections['vert'])
+    intensity = np.asarray(sections['intensity']).reshape(-1, 2)
+
+    if horz.shape != vert.shape or horz.shape[1] != len(defocus) + 1 or \
+            len(intensity) != len(defocus):
+        raise ValueError(
+            'The sections of %s do not have the same number of planes.' %
+            path)
+
+    if freqs is not None:
+        rows = np.in1d(horz[:, 0], freqs)
+        horz, vert = horz[rows], vert[rows]
+
+    return THFRecord(path, defocus, horz, vert, intensity, sections['header'])
+
+
+def _pad_stack(arrays, fill=np.nan, dtype=float):
+    """
+    Stacks arrays of the same number of dimensions but possibly different
+    shapes (e.g. files with different numbers of planes) into one array.
+
+    Parameters
+    ==========
+    arrays : iterable of numpy.ndarray
+
+    fill : float
+        value for the entries that an array does not cover
+
+    dtype : numpy dtype
+        float type of the output
+
+    Returns
+    =======
+    output : numpy.ndarray
+        array of shape ``(len(arrays),) + largest shape``
+    """
+    arrays = list(arrays)
+    if not arrays:
+        return np.empty((0,))
+
+    shape = np.max([array.shape for array in arrays], axis=0)
+    output = np.empty((len(arrays),) + tuple(shape), dtype=dtype)
+    output.fill(fill)
+    for n, array in enumerate(arrays):
+        output[(n,) + tuple(slice(0, m) for m in array.shape)] = array
+
+    return output
+
+
+def stack_records(records, dtype=float):
+    """
+    Stacks parsed records into arrays, so that a whole directory can be
+    processed with array operations instead of per-file loops.
+
+    Files with fewer frequencies or defocus planes than the others are padded
+    with NaN.
+
+    Parameters
+    ==========
+    records : iterable of THFRecord
+        e.g. the output of ``iter_thf``
+
+    dtype : numpy dtype (optional)
+        float type of the MTF and intensity arrays; ``np.float32`` halves
+        the memory.  The frequencies and defocus positions are small and
+        are always float64, so that they keep their exact values.
+
+    Returns
+    =======
+    stack : THFStack
+        ``(paths, freqs, defocus, horz, vert, intensity, headers)``, where
+
+        #. ``paths`` -- list of the file paths
+        #. ``freqs`` -- (files x freqs) spatial frequencies
+        #. ``defocus`` -- (files x planes) defocus positions
+        #. ``horz``, ``vert`` -- (files x freqs x planes) MTF, without the
+           frequency column
+        #. ``intensity`` -- (files x planes x 2) defocus intensity
+        #. ``headers`` -- dict of each header field to a list of its values
+
+    See Also
+    ========
+    iter_thf, load_MTF_store
+    """
+    paths, freqs, defocus, horz, vert, intensity, headers = (
+        [], [], [], [], [], [], [])
+    for record in records:
+        paths.append(record.path)
+        freqs.append(record.horz[:, 0])
+        defocus.append(record.defocus)
+        horz.append(record.horz[:, 1:])
+        vert.append(record.vert[:, 1:])
+        intensity.append(record.intensity)
+        headers.append(record.header)
+
+    if not paths:
+        raise NoTHFFilesError('No .thf files to stack.')
+
+    fields = sorted(set(name for header in headers for name in header))
+
+    return THFStack(
+        paths,
+        _pad_stack(freqs),
+        _pad_stack(defocus),
+        _pad_stack(horz, dtype=dtype),
+        _pad_stack(vert, dtype=dtype),
+        _pad_stack(intensity, dtype=dtype),
+        dict((name, [header.get(name, '') for header in headers])
+             for name in fields))
+
+
+def stack_THF_files(selected_dir, dtype=float, quarantine=None,
+                    duplicates=None, numeric_only=False, workers=None):
+    """
+    Reads every ``.thf`` file in the selected directory into one stack.  An
+    MTF store is opened directly (memory-mapped) instead of being rebuilt.
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to a folder, a ``.zip`` or ``.tar(.gz)`` archive, or an MTF store
+
+    dtype : numpy dtype (optional)
+        float type of the MTF and intensity arrays; see ``stack_records``
+        (ignored for an MTF store, which is always float32)
+
+    quarantine : list (optional)
+        collects the files that cannot be read instead of raising; see
+        ``iter_thf``
+
+    duplicates, numeric_only : list, boolean (optional)
+        leave out (and collect) the files that duplicate an earlier file, so
+        that they do not count twice in lot statistics; see ``iter_thf``
+
+    workers : integer (optional)
+        If given, the files are parsed by this many worker processes, which
+        write the tables straight into one shared-memory block instead of
+        sending them back.  The block is sized up front by a quick count of
+        the rows of every file (no numbers are parsed), so files with more
+        frequencies or planes than others fit too.  The arrays of the stack
+        are views of that block, so nothing is copied or pickled.  Use
+        ``dtype=np.float32`` to halve the block; the source data only has
+        two decimals.  (A ``.tar.gz`` file is always read by this process;
+        see ``iter_thf``.)
+
+    Returns
+    =======
+    stack : THFStack
+        With "workers", ``horz`` and ``vert`` are the two halves of one
+        (files x orientation x freqs x planes) array.
+
+    See Also
+    ========
+    stack_records, load_MTF_store
+    """
+    is_store = os.path.isfile(os.path.join(selected_dir, _STORE_MANIFEST))
+    if is_store and duplicates is None:
+        return load_MTF_store(selected_dir)
+
+    is_tar = os.path.isfile(selected_dir) and \
+        not zipfile.is_zipfile(selected_dir)
+    if workers and not (is_store or is_tar):
+        paths = iter_file_paths(selected_dir)
+        if duplicates is not None:
+            paths = iter_unique_paths(paths, numeric_only, duplicates)
+        return _stack_shared(list(paths), None, workers, dtype, quarantine)
+
+    return stack_records(
+        iter_thf(selected_dir, quarantine=quarantine, duplicates=duplicates,
+                 numeric_only=numeric_only),
+        dtype=dtype)
+
+
+def _stacked_records(selected_dir, dtype, quarantine, duplicates, workers):
+    """
+    Reads every ``.thf`` file in the selected directory with
+    ``stack_THF_files`` (in shared memory, with "workers") and returns the
+    files as a list of THFRecord, for the plots that draw one file at a
+    time.  The list is empty if no file can be read.
+
+    This is not zero-copy: each record is a float64 copy of its file's rows
+    of the stack (see ``_store_record``), and the stack itself is dropped.
+    The workers save the parsing time, not the memory of the records.
+    """
+    try:
+        stack = stack_THF_files(
+            selected_dir, dtype, quarantine, duplicates, numeric_only=True,
+            workers=workers)
+    except NoTHFFilesError:
+        return []
+
+    return [_store_record(stack, idx) for idx in range(len(stack.paths))]
+
+
+def common_defocus_grid(stack):
+    """
+    Makes one defocus grid that covers every file in a stack without losing
+    any measured plane: the grid is the union of the defocus positions of
+    all the files.
+
+    Positions that are much closer together than the finest plane spacing
+    in the stack (less than a tenth of it, e.g. -40.00 and -40.01) are the
+    same plane and are kept only once (the smallest one), so small
+    differences in the stage positions do not blow up the size of the grid.
+    ``resample_defocus`` treats a grid point that close to a file's first or
+    last plane as inside the file's range, so no file loses its end planes.
+
+    Parameters
+    ==========
+    stack : THFStack
+        e.g. the output of ``stack_records`` or ``load_MTF_store``
+
+    Returns
+    =======
+    grid : 1D array of floats
+        increasing defocus positions (microns).  The spacing is not even if
+        the files were measured with different spacings.
+    """
+    defocus = np.asarray(stack.defocus, dtype=float)
+    positions = np.unique(defocus[~np.isnan(defocus)])
+    if len(positions) < 2:
+        return positions
+
+    keep = np.concatenate((
+        [True], np.diff(positions) >= _plane_tolerance(defocus)))
+
+    return positions[keep]
+
+
+def _plane_tolerance(defocus):
+    """
+    Returns the distance under which two defocus positions are the same
+    plane: a tenth of the finest plane spacing in "defocus" (files x planes,
+    NaN-padded), or 0 if there is no spacing.
+    """
+    steps = np.diff(defocus, axis=1)
+    with np.errstate(invalid='ignore'):  # NaN compares as False
+        steps = steps[steps > 0]
+    if len(steps) == 0:
+        return 0.0
+
+    return steps.min()/10.0
+
+
+def _interp_planes(defocus, data, grid, tolerance=0.0):
+    """
+    Linearly interpolates the last axis of "data" from each file's defocus
+    positions onto "grid", for all files at once.
+
+    Parameters
+    ==========
+    defocus : numpy.ndarray
+        (files x planes) increasing defocus positions, NaN-padded
+
+    data : numpy.ndarray
+        (files x ... x planes) values at those positions
+
+    grid : 1D array of floats
+        the new defocus positions
+
+    tolerance : float (optional)
+        grid points up to this far outside a file's range take the value of
+        its first or last plane instead of NaN
+
+    Returns
+    =======
+    output : numpy.ndarray
+        (files x ... x len(grid)) values, NaN outside each file's range
+    """
+    n_files, n_planes = defocus.shape
+    n_valid = np.count_nonzero(~np.isnan(defocus), axis=1)
+    rows = np.arange(n_files)[:, np.newaxis]
+    first = defocus[:, :1]
+    last = defocus[rows, n_valid[:, np.newaxis] - 1]
+
+    # Shift each file's positions into its own range so that one sorted
+    # search finds the plane interval of every grid point in every file
+    positions = np.where(np.isnan(defocus), last, defocus)
+    span = np.nanmax(positions) - np.nanmin(positions)
+    span = max(span, np.ptp(grid)) + 1.0
+    offset = rows * 2 * span
+    idx = np.searchsorted(
+        (positions + offset).ravel(), (grid + offset).ravel(), side='right')
+    idx = idx.reshape(n_files, len(grid)) - 1 - rows * n_planes
+    idx = np.clip(idx, 0, np.maximum(n_valid - 2, 0)[:, np.newaxis])
+
+    x0 = positions[rows, idx]
+    x1 = positions[rows, idx + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = (grid - x0)/(x1 - x0)
+    weight = np.clip(weight, 0.0, 1.0)  # within the tolerance of the ends
+    weight[(grid < first - tolerance) | (grid > last + tolerance)] = np.nan
+
+    # Bring the planes axis next to the files axis for the fancy indexing
+    planes_first = np.moveaxis(np.asarray(data, dtype=float), -1, 1)
+    y0 = planes_first[rows, idx]
+    y1 = planes_first[rows, idx + 1]
+    weight = weight.reshape(weight.shape + (1,)*(y0.ndim - 2))
+
+    return np.moveaxis(y0 + weight*(y1 - y0), 1, -1)
+
+
+def resample_defocus(stack, grid=None):
+    """
+    Resamples every file in a stack onto one shared defocus grid, so that
+    lot averages, differences, and overlaps are plain array operations, e.g.
+    ``np.nanmean(resample_defocus(stack).horz, axis=0)``.
+
+    All the files are interpolated at once (linear interpolation between
+    planes); no per-file loop is needed.
+
+    Parameters
+    ==========
+    stack : THFStack
+        e.g. the output of ``stack_records`` or ``load_MTF_store``.  The
+        defocus positions of each file must be increasing.
+
+    grid : 1D array of floats (optional)
+        the shared defocus positions (microns).  The default is
+        ``common_defocus_grid(stack)``.
+
+    Returns
+    =======
+    resampled : THFStack
+        the same files, where ``defocus`` is "grid" for every file and
+        ``horz``, ``vert``, and ``intensity`` are interpolated onto it.
+        Values outside a file's own defocus range are NaN; grid points
+        closer to its first or last plane than a tenth of the finest plane
+        spacing in the stack (see ``common_defocus_grid``) take the value of
+        that plane.
+
+    See Also
+    ========
+    common_defocus_grid, stack_records
+    """
+    if grid is None:
+        grid = common_defocus_grid(stack)
+    grid = np.asarray(grid, dtype=float)
+    defocus = np.asarray(stack.defocus, dtype=float)
+    tolerance = _plane_tolerance(defocus)
+
+    # "intensity" is (files x planes x 2), so put its planes axis last
+    intensity = _interp_planes(
+        defocus, np.moveaxis(stack.intensity, 1, -1), grid, tolerance)
+
+    return stack._replace(
+        defocus=np.tile(grid, (len(stack.paths), 1)),
+        horz=_interp_planes(defocus, stack.horz, grid, tolerance),
+        vert=_interp_planes(defocus, stack.vert, grid, tolerance),
+        intensity=np.moveaxis(intensity, -1, 1))
+
+
+def pull_defocus_intensity(path):
+    """
+    Pulls the "Defocus Intensity Data: Horiz	Vert" section and returns it.
 
-    with open(path) as infile:
-        copy = False
+    Parameters
+    ==========
+    path : string
+        through-focus MTF data file ending in ``.thf`` or ``.THF``
 
-        for line in infile:
-            if line.strip() == "Defocus Position":
-                copy = True
-            elif line.strip() == "":
-                copy = False
-            elif copy:
-                defocus.append(line.strip().split('\t'))
+    Returns
+    =======
+    intensity : array of floats
+        (planes x 2) numpy.ndarray of the horizontal (first column) and
+        vertical (second column) intensity at each defocus position
 
-    return np.asarray(defocus).astype(float)
+    See Also
+    ========
+    find_zero_intensity_planes
+    """
+    return read_THF_file(path).intensity
 
 
 def flatten_and_name_array(path, slicename, input_array):
@@ -241,7 +942,8 @@ def flatten_and_name_array(path, slicename, input_array):
     return name, named_output
 
 
-def plot_one_THF_file(path, title, freqs, spec_lines, plot_avg, input_colors):
+def plot_one_THF_file(
+        path, title, freqs, spec_lines, plot_avg, input_colors, record=None):
     """
     For one given path and desired input frequencies, extract and plot at
     least one through-focus MTF curve as a function of defocus position.
@@ -264,6 +966,10 @@ def plot_one_THF_file(path, title, freqs, spec_lines, plot_avg, input_colors):
         If true, then plot the average of the MTF.  Otherwise, plot horizontal
         and vertical MTF separately.
 
+    record : THFRecord (optional)
+        the data of "path", if it was already read (e.g. by
+        ``stack_THF_files``); otherwise "path" is read
+
     Returns
     =======
     output_data : list
@@ -276,8 +982,12 @@ def plot_one_THF_file(path, title, freqs, spec_lines, plot_avg, input_colors):
         solid lines with points for the horizontal data and dashed lines with
         points for the vertical data.
     """
-    defocus = pull_defocus(path)  # defocus positions along the z-axis
-    horz, vert, avg = pull_MTF_data(path, freqs)  # MTF at desired freqs
+    if record is None:
+        defocus = pull_defocus(path)  # defocus positions along the z-axis
+        horz, vert, avg = pull_MTF_data(path, freqs)  # MTF at desired freqs
+    else:
+        defocus = record.defocus.reshape(-1, 1)
+        horz, vert, avg = _MTF_rows(record.horz, record.vert, freqs)
 
     # Put the defocus data into "output_data"; it's a little hokey, but it
     # creates a list of the defocus values, so that we will end up with a
@@ -355,44 +1065,1859 @@ def plot_one_THF_file(path, title, freqs, spec_lines, plot_avg, input_colors):
     return output_data
 
 
-def get_all_file_paths(selected_dir):
+def iter_file_paths(selected_dir):
     """
-    Walks through the selected directory, and if the file path ends in ``.thf``
-    or ``.THF``, then that path is appended to a list.
-
-    This is used to plot multiple ``.thf`` files by generating the list of
-    ``.thf`` paths and then feeding that list to the :func:`.plot_single_THF`
-    function, which will then step through the list and plot each file.
+    Walks through the selected directory and yields each path ending in
+    ``.thf`` or ``.THF`` as soon as it is found.
 
     Parameters
     ==========
     selected_dir : string
-        path to a folder (i.e. directory) containing at least one ``.thf`` file
-
-        .. todo:: throw error if no .thf file in directory
+        path to a folder (i.e. directory) containing ``.thf`` files, to a
+        ``.zip`` or ``.tar(.gz)`` archive of ``.thf`` files, or to an MTF
+        store (see ``write_MTF_store``)
 
     Returns
     =======
-    all_paths : list of strings
-        Returns a list of all the paths ending in ``.thf`` or ``.THF`` in the
-        selected directory.
+    output : generator of strings
+        the ``.thf`` paths in the selected directory.  Archive members and
+        files in a store are yielded as ``archive/member`` paths, which all
+        the ``pull_*`` functions accept.
 
     See Also
     ========
-    plot_single_THF
+    get_all_file_paths, iter_thf
     """
-    all_paths = [
-        os.path.join(dir_name, file_name)
-        for dir_name, sub_dir_list, file_list in os.walk(selected_dir)
-        for file_name in file_list
-        if file_name.lower().endswith('.thf')]
+    if os.path.isfile(os.path.join(selected_dir, _STORE_MANIFEST)):
+        for path in load_MTF_store(selected_dir).paths:
+            yield path
+
+    elif os.path.isfile(selected_dir) and zipfile.is_zipfile(selected_dir):
+        with _archive_lock:
+            names = _open_zip(selected_dir).namelist()
+        for name in names:
+            if name.lower().endswith('.thf'):
+                yield os.path.join(selected_dir, name)
+
+    elif os.path.isfile(selected_dir) and tarfile.is_tarfile(selected_dir):
+        with tarfile.open(selected_dir) as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith('.thf'):
+                    yield os.path.join(selected_dir, member.name)
+
+    else:
+        for dir_name, sub_dir_list, file_list in os.walk(selected_dir):
+            for file_name in file_list:
+                if file_name.lower().endswith('.thf'):
+                    yield os.path.join(dir_name, file_name)
+
+
+def get_all_file_paths(selected_dir):
+    """
+    Walks through the selected directory, and if the file path ends in ``.thf``
+    or ``.THF``, then that path is appended to a list.  The selected directory
+    can also be a ``.zip`` or ``.tar(.gz)`` archive.
+
+    This is used to plot multiple ``.thf`` files by generating the list of
+    ``.thf`` paths and then feeding that list to the :func:`.plot_single_THF`
+    function, which will then step through the list and plot each file.
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to a folder (i.e. directory) containing at least one ``.thf`` file
+
+        .. todo:: throw error if no .thf file in directory
+
+    Returns
+    =======
+    all_paths : list of strings
+        Returns a list of all the paths ending in ``.thf`` or ``.THF`` in the
+        selected directory.
+
+    See Also
+    ========
+    plot_single_THF
+    """
+    all_paths = list(iter_file_paths(selected_dir))
 
     return all_paths
 
 
+def iter_unique_paths(paths, numeric_only=False, duplicates=None):
+    """
+    Generator stage that drops the files whose contents are the same as an
+    earlier file's, e.g. measurements copied into several lot folders under
+    different names.  Only the first copy of each file is yielded, so every
+    measurement is parsed and plotted once.
+
+    Parameters
+    ==========
+    paths : iterable of strings
+        e.g. the output of ``iter_file_paths``
+
+    numeric_only : boolean (optional)
+        If true, then files with the same numeric sections but different
+        headers (e.g. saved at another time) are duplicates too; see
+        ``hash_THF_file``.
+
+    duplicates : list (optional)
+        If given, a ``(path, original_path)`` tuple is appended to this list
+        for each file that is dropped.
+
+    Returns
+    =======
+    output : generator of strings
+        Files that cannot be opened are passed on, so that the reader can
+        report them.
+
+    See Also
+    ========
+    hash_THF_file, iter_thf
+    """
+    seen = {}  # hash -> first path with that hash
+    for path in paths:
+        try:
+            digest = hash_THF_file(path, numeric_only)
+        except (ValueError, EnvironmentError):
+            yield path
+            continue
+
+        if digest in seen:
+            if duplicates is not None:
+                duplicates.append((path, seen[digest]))
+            continue
+
+        seen[digest] = path
+        yield path
+
+
+def _check_THF_head(head, size):
+    """
+    Returns the reason why a file with these first bytes and this size is
+    not a ``.thf`` file, or None if it looks like one.
+    """
+    if size < _MIN_THF_SIZE:
+        return 'too small to be a .thf file (%d bytes)' % size
+    if not head.startswith(_THF_SIGNATURE):
+        return 'not a through-focus MTF file (no THRUFOCUS signature)'
+
+    return None
+
+
+def sniff_THF_file(path):
+    """
+    Cheaply checks whether a file looks like a through-focus MTF file, by
+    reading only its size and its first few bytes.
+
+    Parameters
+    ==========
+    path : string
+        path to a file, a member of a zip archive, or a file in an MTF store
+        (members of a tar archive and files in a store always pass, since
+        they are checked when they are read)
+
+    Returns
+    =======
+    reason : string or None
+        None if the file looks fine; otherwise, why it does not
+
+    See Also
+    ========
+    iter_thf
+    """
+    if _split_store_path(path)[0] is not None:
+        return None
+
+    archive_path, member_name = _split_archive_path(path)
+    if archive_path is None:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as infile:
+            head = infile.read(len(_THF_SIGNATURE))
+    elif zipfile.is_zipfile(archive_path):
+        with _archive_lock:
+            archive = _open_zip(archive_path)
+            size = archive.getinfo(member_name).file_size
+            head = archive.open(member_name).read(len(_THF_SIGNATURE))
+    else:
+        data = _read_THF_bytes(path)
+        size = len(data)
+        head = data[:len(_THF_SIGNATURE)]
+
+    return _check_THF_head(head, size)
+
+
+def _read_checked(path, freqs, data=None):
+    """
+    Sniffs and reads one ``.thf`` file (from "data", if given, instead of
+    from "path") without raising on a bad file.
+
+    Returns
+    =======
+    path, record, reason
+        "record" is None and "reason" says why if the file cannot be read
+    """
+    try:
+        if data is None:
+            reason = sniff_THF_file(path)
+        else:
+            reason = _check_THF_head(data[:len(_THF_SIGNATURE)], len(data))
+        if reason is not None:
+            return path, None, reason
+
+        if data is None:
+            return path, read_THF_file(path, freqs), None
+        lines = io.StringIO(data.decode('latin-1'))
+        return path, _make_record(path, lines, freqs), None
+
+    except (ValueError, EnvironmentError) as error:
+        return path, None, str(error)
+
+
+def try_read_THF_file(path, freqs=None):
+    """
+    Checks and reads one ``.thf`` file like ``read_THF_file``, but returns
+    why a bad file cannot be read instead of raising, e.g. for batch jobs
+    that skip bad files.
+
+    Returns
+    =======
+    record : THFRecord
+        None if the file cannot be read
+
+    reason : string
+        why the file cannot be read (see ``sniff_THF_file``); None if it
+        was read
+    """
+    return _read_checked(path, freqs)[1:]
+
+
+def _read_THF_worker(args):
+    """
+    Worker for ``iter_thf``: reads (and decompresses, for archive members)
+    one ``.thf`` file in a separate process.
+    """
+    path, freqs = args
+    return _read_checked(path, freqs)
+
+
+def _init_zip_worker():
+    """
+    Pool initializer for ``iter_thf``: makes each worker process open its
+    own zip handle instead of using one inherited from the parent.  (A
+    module-level function, so that it can be pickled on Windows.)
+    """
+    _zip_cache.clear()
+
+
+def _iter_tar_members(selected_dir, freqs, numeric_only=False,
+                      duplicates=None):
+    """
+    Reads the ``.thf`` members of a tar archive front to back, one at a time.
+    Yields the same ``(path, record, reason)`` as ``_read_checked``.  If
+    "duplicates" is given, then members are skipped as in
+    ``iter_unique_paths``.
+    """
+    seen = {}
+    with tarfile.open(selected_dir) as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith('.thf'):
+                path = os.path.join(selected_dir, member.name)
+                data = archive.extractfile(member).read()
+
+                if duplicates is not None:
+                    digest = _hash_THF_data(data, numeric_only)
+                    if digest in seen:
+                        duplicates.append((path, seen[digest]))
+                        continue
+                    seen[digest] = path
+
+                yield _read_checked(path, freqs, data)
+
+
+def _shared_arrays(buffers):
+    """
+    Wraps the shared buffers of ``_alloc_shared`` as numpy arrays, without
+    copying.
+    """
+    return dict(
+        (name, np.frombuffer(raw, dtype=np.dtype(typecode)).reshape(shape))
+        for name, (raw, shape, typecode) in buffers.items())
+
+
+def _alloc_shared(n_files, n_freqs, n_planes, dtype):
+    """
+    Allocates NaN-filled shared-memory buffers for a stack of "n_files"
+    files: ``MTF`` (files x orientation x freqs x planes, with horz then
+    vert), ``freqs``, ``defocus`` and ``intensity``.  "dtype" is the type of
+    ``MTF`` and ``intensity``; ``freqs`` and ``defocus`` are always float64
+    (see ``stack_records``).
+
+    Returns
+    =======
+    buffers : dictionary
+        ``name -> (RawArray, shape, typecode)``; can be passed to worker
+        processes
+    """
+    typecode = {np.dtype(np.float32): 'f', np.dtype(np.float64): 'd'}.get(
+        np.dtype(dtype))
+    if typecode is None:
+        raise ValueError('Shared stacks must be float32 or float64.')
+
+    shapes = {
+        'MTF': ((n_files, 2, n_freqs, n_planes), typecode),
+        'freqs': ((n_files, n_freqs), 'd'),
+        'defocus': ((n_files, n_planes), 'd'),
+        'intensity': ((n_files, n_planes, 2), typecode),
+    }
+    buffers = dict(
+        (name, (multiprocessing.RawArray(typecode, int(np.prod(shape))),
+                shape, typecode))
+        for name, (shape, typecode) in shapes.items())
+    for array in _shared_arrays(buffers).values():
+        array.fill(np.nan)
+
+    return buffers
+
+
+def _write_shared(arrays, idx, record):
+    """
+    Copies one record into row "idx" of the shared arrays.  Returns False
+    (and copies nothing) if the record does not fit.
+    """
+    n_freqs, n_planes = record.horz.shape[0], record.horz.shape[1] - 1
+    if n_freqs > arrays['freqs'].shape[1] or \
+            n_planes > arrays['defocus'].shape[1]:
+        return False
+
+    arrays['MTF'][idx, 0, :n_freqs, :n_planes] = record.horz[:, 1:]
+    arrays['MTF'][idx, 1, :n_freqs, :n_planes] = record.vert[:, 1:]
+    arrays['freqs'][idx, :n_freqs] = record.horz[:, 0]
+    arrays['defocus'][idx, :n_planes] = record.defocus
+    arrays['intensity'][idx, :n_planes] = record.intensity
+    return True
+
+
+def _init_shared_worker(buffers):
+    """
+    Pool initializer for ``_stack_shared``: attaches this worker process to
+    the shared buffers.
+    """
+    _init_zip_worker()
+    _shared_worker_arrays.clear()
+    _shared_worker_arrays.update(_shared_arrays(buffers))
+
+
+def _fill_shared_worker(args):
+    """
+    Worker for ``_stack_shared``: reads one ``.thf`` file and writes its
+    tables straight into the shared buffers, so only the header (or the
+    whole record, if it does not fit) is sent back.
+
+    Returns
+    =======
+    idx, header, reason, record
+    """
+    idx, path, freqs = args
+    path, record, reason = _read_checked(path, freqs)
+    if record is None:
+        return idx, None, reason, None
+
+    if _write_shared(_shared_worker_arrays, idx, record):
+        return idx, record.header, None, None
+    return idx, record.header, None, record
+
+
+def _THF_shape(lines):
+    """
+    Counts the spatial frequencies and the defocus planes of one ``.thf``
+    file from its lines, without parsing any numbers.
+
+    Returns
+    =======
+    n_freqs, n_planes : integers
+    """
+    counts = {'horz': 0, 'defocus': 0}
+    current = None
+    for line in lines:
+        stripped = line.strip()
+        if stripped in _SECTION_HEADERS:
+            current = _SECTION_HEADERS[stripped]
+        elif current in counts and stripped:
+            if stripped[0] in '+-.0123456789':
+                counts[current] += 1
+            else:  # any other header ends the current section
+                current = None
+
+    return counts['horz'], counts['defocus']
+
+
+def _THF_shape_worker(path):
+    """
+    Worker for ``_stack_shared``: counts the frequencies and the planes of
+    one ``.thf`` file (see ``_THF_shape``).  Returns None if the file cannot
+    be read.
+    """
+    try:
+        with _open_THF(path) as infile:
+            return _THF_shape(infile)
+    except EnvironmentError:
+        return None
+
+
+def _stack_shared(paths, freqs, workers, dtype, quarantine):
+    """
+    Reads the given ``.thf`` files with a pool of worker processes that
+    write straight into one shared-memory block.  See ``stack_THF_files``.
+    """
+    headers = [None]*len(paths)
+    unwritten = []  # (idx, record) of the files that are not in the block
+
+    def set_aside(idx, reason):
+        if quarantine is None:
+            raise ValueError('Cannot read %s: %s' % (paths[idx], reason))
+        quarantine.append((paths[idx], reason))
+
+    # Size the block up front from a quick count of the rows of every file,
+    # so that every file can be written straight into it
+    pool = multiprocessing.Pool(workers, initializer=_init_zip_worker)
+    try:
+        shapes = [shape for shape in pool.map(
+            _THF_shape_worker, paths, chunksize=16) if shape is not None]
+    finally:
+        pool.terminate()
+    n_freqs = max([1] + [shape[0] for shape in shapes])
+    n_planes = max([1] + [shape[1] for shape in shapes])
+    if freqs is not None:
+        n_freqs = min(n_freqs, max(len(freqs), 1))
+    buffers = _alloc_shared(len(paths), n_freqs, n_planes, dtype)
+
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_shared_worker, initargs=(buffers,))
+    try:
+        tasks = [(idx, paths[idx], freqs) for idx in range(len(paths))]
+        for idx, header, reason, record in pool.imap_unordered(
+                _fill_shared_worker, tasks, chunksize=16):
+            if reason is not None:
+                set_aside(idx, reason)
+                continue
+            headers[idx] = header
+            if record is not None:
+                unwritten.append((idx, record))
+    finally:
+        pool.terminate()
+
+    arrays = _shared_arrays(buffers)
+    if unwritten:
+        # Only if the count was short (i.e. a file with an odd layout): move
+        # everything into a bigger block
+        n_freqs = max([n_freqs] + [
+            len(record.horz) for idx, record in unwritten])
+        n_planes = max([n_planes] + [
+            len(record.defocus) for idx, record in unwritten])
+        old_arrays = arrays
+        arrays = _shared_arrays(
+            _alloc_shared(len(paths), n_freqs, n_planes, dtype))
+        for name, array in old_arrays.items():
+            arrays[name][tuple(slice(0, m) for m in array.shape)] = array
+        for idx, record in unwritten:
+            _write_shared(arrays, idx, record)
+
+    # Close the gaps left by the bad files in place, keeping the order
+    keep = [idx for idx, header in enumerate(headers) if header is not None]
+    if not keep:
+        raise NoTHFFilesError('No .thf files to stack.')
+    for new, old in enumerate(keep):
+        if new != old:
+            for array in arrays.values():
+                array[new] = array[old]
+    arrays = dict((name, array[:len(keep)])
+                  for name, array in arrays.items())
+
+    headers = [headers[idx] for idx in keep]
+    fields = sorted(set(name for header in headers for name in header))
+
+    return THFStack(
+        [paths[idx] for idx in keep],
+        arrays['freqs'],
+        arrays['defocus'],
+        arrays['MTF'][:, 0],
+        arrays['MTF'][:, 1],
+        arrays['intensity'],
+        dict((name, [header.get(name, '') for header in headers])
+             for name in fields))
+
+
+def iter_thf(selected_dir, freqs=None, workers=None, quarantine=None,
+             duplicates=None, numeric_only=False):
+    """
+    Streams the ``.thf`` files in the selected directory, yielding one parsed
+    record per file as soon as it is read.
+
+    Only one file is held in memory at a time, so any number of files can be
+    processed by chaining generator stages onto this one, e.g.::
+
+        records = iter_thf(selected_dir, freqs=[52, 104])
+        rows = iter_output_data(records, plot_avg=True)
+        write_output_data(rows, 'lot.txt')
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to a folder (i.e. directory) containing ``.thf`` files, or to a
+        ``.zip`` or ``.tar(.gz)`` archive of ``.thf`` files, or to an MTF
+        store.  Archive members are streamed straight into the parser without
+        temporary files; a store is read without parsing at all.
+
+    freqs : 1D list of floats (optional)
+        If given, only the MTF rows at these spatial frequencies are kept in
+        each record.
+
+    workers : integer (optional)
+        If given, the files are read and parsed by this many worker
+        processes; records are still yielded in order.  Zip members are also
+        decompressed in the workers.  A ``.tar.gz`` file is one compressed
+        stream, so its members are always read in order by this process.
+
+    quarantine : list (optional)
+        If given, files that are not through-focus MTF files or that cannot
+        be read (e.g. truncated files) are skipped, and a
+        ``(path, reason)`` tuple is appended to this list for each one.
+        Otherwise, the first bad file raises a ValueError.
+
+    duplicates : list (optional)
+        If given, files with the same contents as an earlier file are
+        skipped before they are parsed, and a ``(path, original_path)``
+        tuple is appended to this list for each one; see
+        ``iter_unique_paths``.
+
+    numeric_only : boolean (optional)
+        If true, then duplicates are found from the numeric sections only,
+        ignoring the headers; see ``hash_THF_file``.
+
+    Returns
+    =======
+    output : generator of THFRecord
+        one ``(path, defocus, horz, vert, intensity)`` record per ``.thf``
+        file
+
+    See Also
+    ========
+    read_THF_file, iter_file_paths, iter_output_data, sniff_THF_file,
+    iter_unique_paths
+    """
+    if os.path.isfile(os.path.join(selected_dir, _STORE_MANIFEST)):
+        # A store only holds files that were read without errors, and it
+        # has no headers, so only the numbers are compared
+        stack = load_MTF_store(selected_dir)
+        seen = {}
+        for idx in range(len(stack.paths)):
+            if duplicates is not None:
+                digest = _hash_record(_store_record(stack, idx))
+                if digest in seen:
+                    duplicates.append((stack.paths[idx], seen[digest]))
+                    continue
+                seen[digest] = stack.paths[idx]
+            yield _store_record(stack, idx, freqs)
+        return
+
+    pool = None
+    paths = iter_file_paths(selected_dir)
+    if duplicates is not None:
+        # Hashing is much cheaper than parsing, so it is done up front here
+        paths = iter_unique_paths(paths, numeric_only, duplicates)
+
+    if os.path.isfile(selected_dir) and not zipfile.is_zipfile(selected_dir):
+        results = _iter_tar_members(
+            selected_dir, freqs, numeric_only, duplicates)
+    elif workers:
+        # Each worker opens its own zip handle instead of sharing this one
+        pool = multiprocessing.Pool(workers, initializer=_init_zip_worker)
+        tasks = ((path, freqs) for path in paths)
+        results = pool.imap(_read_THF_worker, tasks, chunksize=16)
+    else:
+        results = (_read_checked(path, freqs) for path in paths)
+
+    try:
+        for path, record, reason in results:
+            if record is not None:
+                yield record
+            elif quarantine is not None:
+                quarantine.append((path, reason))
+            else:
+                raise ValueError('Cannot read %s: %s' % (path, reason))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def find_zero_intensity_planes(selected_dir):
+    """
+    Flags the defocus planes with zero intensity in every ``.thf`` file in
+    the selected directory.  A zero-intensity plane usually means a bad focus
+    scan.
+
+    The intensity data is read in the same pass as the MTF data, and the
+    check is done on the stacked (files x planes x 2) array at once.
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to a folder (i.e. directory) containing ``.thf`` files
+
+    Returns
+    =======
+    all_paths : list of strings
+        the ``.thf`` paths, in the same order as the rows of ``zero_planes``
+
+    zero_planes : 2D array of booleans
+        (files x planes) array that is true where the horizontal or vertical
+        intensity is zero.  ``zero_planes.any(axis=1)`` flags the bad files.
+
+    See Also
+    ========
+    pull_defocus_intensity
+    """
+    all_paths = []
+    all_intensity = []
+    for record in iter_thf(selected_dir, freqs=[]):
+        all_paths.append(record.path)
+        all_intensity.append(record.intensity)
+
+    if not all_paths:
+        return all_paths, np.zeros((0, 0), dtype=bool)
+
+    intensity = _pad_stack(all_intensity)  # NaN padding is never zero
+    zero_planes = (intensity == 0).any(axis=2)
+
+    return all_paths, zero_planes
+
+
+def iter_output_data(records, plot_avg):
+    """
+    Generator stage that turns parsed records into the named, flattened rows
+    returned by ``plot_one_THF_file``, without plotting anything.
+
+    Parameters
+    ==========
+    records : iterable of THFRecord
+        e.g. the output of ``iter_thf``
+
+    plot_avg : boolean
+        If true, then yield the average of the MTF.  Otherwise, yield the
+        horizontal and vertical MTF separately.
+
+    Returns
+    =======
+    output : generator of lists
+        For each record, the defocus row followed by one row per frequency
+        (and orientation), each with its name as the first entry.
+
+    See Also
+    ========
+    iter_thf, write_output_data, plot_one_THF_file
+    """
+    for record in records:
+        filename = os.path.basename(record.path)[:-4]  # removes ".thf"
+        yield [filename + ' defocus (um)'] + [
+            str(number) for number in record.defocus.tolist()]
+
+        for n in range(len(record.horz)):
+            if plot_avg:
+                average_MTF = np.add(record.horz[n], record.vert[n])/2
+                yield flatten_and_name_array(
+                    record.path, 'avg', average_MTF)[1]
+            else:
+                yield flatten_and_name_array(
+                    record.path, 'horz', record.horz[n])[1]
+                yield flatten_and_name_array(
+                    record.path, 'vert', record.vert[n])[1]
+
+
+def write_output_data(rows, output_path):
+    """
+    Final stage of a streaming pipeline: writes each row to a tab-separated
+    text file as it arrives.
+
+    Parameters
+    ==========
+    rows : iterable of lists
+        e.g. the output of ``iter_output_data``
+
+    output_path : string
+        path of the text file to write
+
+    Returns
+    =======
+    count : integer
+        number of rows written
+
+    See Also
+    ========
+    iter_output_data
+    """
+    count = 0
+    with open(output_path, 'w') as outfile:
+        for row in rows:
+            outfile.write('\t'.join(row) + '\n')
+            count += 1
+
+    return count
+
+
+def write_MTF_store(selected_dir, store_dir, workers=None, quarantine=None):
+    """
+    Converts a directory or archive of ``.thf`` files into an MTF store: one
+    compact binary file per column, so that the data never has to be parsed
+    again.
+
+    The store can be used anywhere a directory of ``.thf`` files can (e.g.
+    ``plot_all``, ``iter_thf`` and the ``pull_*`` functions, with
+    ``store_dir/file.thf`` paths).
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to a folder, ``.zip`` or ``.tar(.gz)`` archive of ``.thf`` files
+
+    store_dir : string
+        path to the new store (a directory, created if needed)
+
+    workers : integer (optional)
+        number of worker processes used to parse the files; see
+        ``stack_THF_files``
+
+    quarantine : list (optional)
+        collects the files that cannot be read instead of raising; see
+        ``iter_thf``
+
+    Returns
+    =======
+    stack : THFStack
+        the stored data, read back from the store
+
+    Notes
+    =====
+    Each array in ``THFStack`` is saved in its own ``.npy`` file
+    (``freqs.npy``, ``defocus.npy``, ``horz.npy``, ``vert.npy`` and
+    ``intensity.npy``).  The file names and header fields are saved as
+    columns in ``MTF_store.json``.  The MTF and intensity tables are saved
+    as float32, which is not exact (e.g. 57.97 is stored as 57.970001);
+    ``read_THF_file`` rounds them back to the two decimals of the source
+    files.  The frequencies and defocus positions are saved as float64.
+
+    See Also
+    ========
+    load_MTF_store, stack_records
+    """
+    stack = stack_THF_files(
+        selected_dir, np.float32, quarantine, workers=workers)
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    # Drop this process's memory maps of an older store in the same place,
+    # so that its files can be overwritten (Windows does not allow writing
+    # to a mapped file)
+    _store_cache.pop(store_dir, None)
+
+    for name in ('freqs', 'defocus', 'horz', 'vert', 'intensity'):
+        np.save(os.path.join(store_dir, name + '.npy'), getattr(stack, name))
+
+    # Keep the file names relative to "selected_dir"
+    names = [
+        os.path.relpath(path, selected_dir).replace('\\', '/')
+        for path in stack.paths]
+    with open(os.path.join(store_dir, _STORE_MANIFEST), 'w') as outfile:
+        json.dump({'names': names, 'headers': stack.headers}, outfile)
+
+    return load_MTF_store(store_dir)
+
+
+def load_MTF_store(store_dir):
+    """
+    Opens an MTF store written by ``write_MTF_store``.
+
+    The arrays are memory-mapped, so opening a store is nearly instant no
+    matter how many files it holds, and only the parts that are used are read
+    from disk.  An open store is reused until its manifest changes (e.g. the
+    store was written again, by this or another process).
+
+    Parameters
+    ==========
+    store_dir : string
+        path to the store
+
+    Returns
+    =======
+    stack : THFStack
+        ``paths`` are ``store_dir/file.thf`` paths, and the arrays are
+        read-only ``numpy.memmap`` arrays (float32 MTF and intensity, and
+        float64 frequencies and defocus positions).
+
+    See Also
+    ========
+    write_MTF_store, stack_records
+    """
+    manifest_path = os.path.join(store_dir, _STORE_MANIFEST)
+    stamp = os.stat(manifest_path)
+    stamp = (stamp.st_mtime, stamp.st_size)
+    if _store_cache.get(store_dir, (None,))[0] != stamp:
+        _store_cache.pop(store_dir, None)  # release the old memory maps
+        with open(manifest_path) as infile:
+            manifest = json.load(infile)
+
+        arrays = dict(
+            (name, np.load(
+                os.path.join(store_dir, name + '.npy'), mmap_mode='r'))
+            for name in ('freqs', 'defocus', 'horz', 'vert', 'intensity'))
+
+        paths = [os.path.join(store_dir, name) for name in manifest['names']]
+        index = dict(
+            (name, idx) for idx, name in enumerate(manifest['names']))
+        _store_cache[store_dir] = (
+            stamp,
+            THFStack(paths=paths, headers=manifest['headers'], **arrays),
+            index)
+
+    return _store_cache[store_dir][1]
+
+
+def _split_store_path(path):
+    """
+    Splits a path to a file in an MTF store into the store directory and the
+    file name (e.g. ``lot_store/a.thf`` into ``lot_store`` and ``a.thf``).
+    The store directory is None if "path" is not in a store.  The file name
+    always uses "/" separators, like the names in the manifest.
+    """
+    if not os.path.exists(path):
+        store_dir = os.path.dirname(path)
+        while store_dir and store_dir != os.path.dirname(store_dir):
+            if os.path.isfile(os.path.join(store_dir, _STORE_MANIFEST)):
+                name = os.path.relpath(path, store_dir)
+                return store_dir, name.replace('\\', '/')
+            store_dir = os.path.dirname(store_dir)
+
+    return None, path
+
+
+def _store_record(stack, idx, freqs=None):
+    """
+    Rebuilds the ``THFRecord`` of file number "idx" in a stack (e.g. an MTF
+    store), without the NaN padding.  See ``read_THF_file``.
+
+    Float32 values are rounded back to the two decimals of the source
+    files, so that e.g. an export of a store matches one of the files.
+    """
+    def exact(array):
+        if array.dtype == np.float32:
+            return np.round(array.astype(float), 2)
+        return array.astype(float)
+
+    n_freqs = np.count_nonzero(~np.isnan(stack.freqs[idx]))
+    n_planes = np.count_nonzero(~np.isnan(stack.defocus[idx]))
+
+    freq_col = exact(stack.freqs[idx, :n_freqs, np.newaxis])
+    horz = np.hstack((freq_col, exact(stack.horz[idx, :n_freqs, :n_planes])))
+    vert = np.hstack((freq_col, exact(stack.vert[idx, :n_freqs, :n_planes])))
+
+    if freqs is not None:
+        rows = np.in1d(horz[:, 0], freqs)
+        horz, vert = horz[rows], vert[rows]
+
+    return THFRecord(
+        stack.paths[idx],
+        exact(stack.defocus[idx, :n_planes]),
+        horz,
+        vert,
+        exact(stack.intensity[idx, :n_planes]),
+        dict((name, values[idx]) for name, values in stack.headers.items()))
+
+
+def _MTF_at_freq(stack, freq, orientation):
+    """
+    Picks the MTF row at one spatial frequency out of every file in a stack.
+
+    Parameters
+    ==========
+    stack : THFStack
+
+    freq : float
+        spatial frequency (lp/mm)
+
+    orientation : string
+        'horz', 'vert', or 'avg'
+
+    Returns
+    =======
+    MTF : numpy.ndarray
+        (files x planes) MTF; all NaN for files without "freq"
+    """
+    match = np.asarray(stack.freqs) == freq
+    rows = match.argmax(axis=1)
+    files = np.arange(len(stack.paths))
+
+    if orientation == 'avg':
+        MTF = (stack.horz[files, rows] + stack.vert[files, rows])/2.0
+    else:
+        MTF = getattr(stack, orientation)[files, rows]
+
+    MTF = np.array(MTF, dtype=float)
+    MTF[~match.any(axis=1)] = np.nan
+
+    return MTF
+
+
+def parse_spec_rules(text):
+    """
+    Converts spec rules written as text (e.g. from the GUI) to a list of
+    ``SpecRule``.
+
+    Parameters
+    ==========
+    text : string
+        Rules separated by semicolons.  Each rule is
+        ``orientation freq min_MTF [defocus_min defocus_max]``, separated by
+        spaces, where "orientation" is 'horz', 'vert', or 'avg'.  For example,
+        ``avg 52 40 -20 20; horz 104 25`` means "the average MTF at 52 lp/mm
+        is at least 40 % from -20 to 20 um, and the horizontal MTF at
+        104 lp/mm reaches 25 %".
+
+    Returns
+    =======
+    rules : list of SpecRule
+
+    See Also
+    ========
+    evaluate_specs
+    """
+    rules = []
+    for rule_text in text.split(';'):
+        fields = rule_text.split()
+        if not fields:
+            continue
+
+        if fields[0] not in ('horz', 'vert', 'avg') or \
+                len(fields) not in (3, 5):
+            raise ValueError('Cannot read the spec rule "%s".' % rule_text)
+
+        numbers = [float(field) for field in fields[1:]] + [None, None]
+        rules.append(SpecRule(fields[0], *numbers[:4]))
+
+    return rules
+
+
+def evaluate_specs(stack, rules):
+    """
+    Evaluates pass/fail spec rules for every file in a stack at once.
+
+    A rule with a defocus range passes if the MTF is at least ``min_MTF`` at
+    every plane inside the range (and there is at least one plane inside it).
+    A rule without a defocus range passes if the MTF reaches ``min_MTF`` at
+    any plane.  A file without the rule's frequency fails the rule.
+
+    Parameters
+    ==========
+    stack : THFStack
+        e.g. the output of ``stack_THF_files``
+
+    rules : list of SpecRule
+        e.g. the output of ``parse_spec_rules``
+
+    Returns
+    =======
+    verdicts : 2D array of booleans
+        (files x rules) array, true where the file passes the rule
+
+    passed : 1D array of booleans
+        true for the files that pass every rule
+
+    lot_yield : float
+        fraction of the files that pass every rule
+
+    See Also
+    ========
+    parse_spec_rules, iter_spec_report
+    """
+    defocus = np.asarray(stack.defocus, dtype=float)
+    verdicts = np.zeros((len(stack.paths), len(rules)), dtype=bool)
+
+    with np.errstate(invalid='ignore'):  # NaN compares as False
+        for k, rule in enumerate(rules):
+            above = _MTF_at_freq(stack, rule.freq, rule.orientation) >= \
+                rule.min_MTF
+
+            if rule.defocus_min is None:
+                verdicts[:, k] = above.any(axis=1)
+            else:
+                in_range = (defocus >= rule.defocus_min) & \
+                    (defocus <= rule.defocus_max)
+                verdicts[:, k] = (above | ~in_range).all(axis=1) & \
+                    in_range.any(axis=1)
+
+    passed = verdicts.all(axis=1)
+    lot_yield = passed.mean() if len(passed) else 0.0
+
+    return verdicts, passed, lot_yield
+
+
+def iter_spec_report(stack, rules, verdicts):
+    """
+    Generator stage that yields the verdict table of ``evaluate_specs`` as
+    rows of strings, e.g. for ``write_output_data``.
+
+    Parameters
+    ==========
+    stack : THFStack
+
+    rules : list of SpecRule
+
+    verdicts : 2D array of booleans
+        the first output of ``evaluate_specs``
+
+    Returns
+    =======
+    output : generator of lists
+        a header row, then one row per file: the file name, "PASS" or "FAIL"
+        for each rule, and the overall verdict
+    """
+    yield ['file'] + [
+        '%s %g lp/mm >= %g' % (rule.orientation, rule.freq, rule.min_MTF) +
+        ('' if rule.defocus_min is None else
+         ' from %g to %g um' % (rule.defocus_min, rule.defocus_max))
+        for rule in rules] + ['overall']
+
+    for path, row in zip(stack.paths, verdicts):
+        yield [os.path.basename(path)] + [
+            'PASS' if verdict else 'FAIL'
+            for verdict in list(row) + [row.all()]]
+
+
+def _match_keys(stack, key):
+    """
+    Returns the key of each file in a stack for ``compare_lots``: the file
+    name if "key" is 'name', otherwise the value of the header field "key".
+    """
+    if key == 'name':
+        keys = [os.path.basename(path) for path in stack.paths]
+    else:
+        keys = list(stack.headers.get(key, [''] * len(stack.paths)))
+
+    duplicates = sorted(k for k, n in Counter(keys).items() if n > 1)
+    if duplicates:
+        raise ValueError(
+            'Cannot match files by "%s"; these values are not unique: %s' %
+            (key, ', '.join(repr(k) for k in duplicates)))
+
+    return keys
+
+
+def compare_lots(reference, test, key='name'):
+    """
+    Compares a test lot with a reference (e.g. golden) lot.  Files are
+    matched by name or by a header field, both lots are resampled onto the
+    defocus grid of the reference lot, and the test minus reference MTF is
+    computed for every matched pair at once.
+
+    Parameters
+    ==========
+    reference, test : string or THFStack
+        the two lots, as paths (directory, archive, or MTF store) or as
+        already-parsed stacks
+
+    key : string (optional)
+        'name' to match files by file name (the default), or the name of a
+        header field such as 'Lens ID' or 'Field Angle'
+
+    Returns
+    =======
+    comparison : LotComparison
+        ``(pairs, freqs, defocus, horz, vert, unmatched)``, where
+
+        #. ``pairs`` -- list of (reference path, test path)
+        #. ``freqs`` -- (pairs x freqs) spatial frequencies
+        #. ``defocus`` -- 1D shared defocus grid
+        #. ``horz``, ``vert`` -- (pairs x freqs x planes) MTF differences,
+           test minus reference, in % MTF
+        #. ``unmatched`` -- list of the paths without a partner
+
+    See Also
+    ========
+    worst_deviations, iter_comparison_report
+    """
+    if not isinstance(reference, THFStack):
+        reference = stack_THF_files(reference)
+    if not isinstance(test, THFStack):
+        test = stack_THF_files(test)
+
+    reference_keys = _match_keys(reference, key)
+    test_keys = _match_keys(test, key)
+    test_idx_by_key = dict((k, idx) for idx, k in enumerate(test_keys))
+
+    reference_idx = [
+        idx for idx, k in enumerate(reference_keys) if k in test_idx_by_key]
+    test_idx = [test_idx_by_key[reference_keys[idx]] for idx in reference_idx]
+    reference_key_set = set(reference_keys)
+    unmatched = (
+        [path for k, path in zip(reference_keys, reference.paths)
+         if k not in test_idx_by_key] +
+        [path for k, path in zip(test_keys, test.paths)
+         if k not in reference_key_set])
+
+    freqs = np.asarray(reference.freqs, dtype=float)[reference_idx]
+    test_freqs = np.asarray(test.freqs, dtype=float)[test_idx]
+    if freqs.shape != test_freqs.shape or \
+            not np.allclose(freqs, test_freqs, equal_nan=True):
+        raise ValueError(
+            'The reference and test files have different spatial '
+            'frequencies.')
+
+    grid = common_defocus_grid(reference)
+    reference = resample_defocus(reference, grid)
+    test = resample_defocus(test, grid)
+
+    return LotComparison(
+        [(reference.paths[r], test.paths[t])
+         for r, t in zip(reference_idx, test_idx)],
+        freqs,
+        grid,
+        test.horz[test_idx] - reference.horz[reference_idx],
+        test.vert[test_idx] - reference.vert[reference_idx],
+        unmatched)
+
+
+def worst_deviations(comparison, count=10):
+    """
+    Finds the largest MTF differences (in absolute value) in a lot
+    comparison.
+
+    Parameters
+    ==========
+    comparison : LotComparison
+        the output of ``compare_lots``
+
+    count : integer (optional)
+        number of deviations to return
+
+    Returns
+    =======
+    worst : list of tuples
+        ``(reference path, test path, orientation, freq, defocus, delta)``
+        sorted from the largest deviation down
+    """
+    deltas = np.stack([comparison.horz, comparison.vert])
+    magnitude = np.abs(deltas).ravel()
+    magnitude[np.isnan(magnitude)] = -1  # never among the worst
+
+    count = min(count, np.count_nonzero(~np.isnan(deltas)))
+    largest = np.argpartition(-magnitude, count - 1)[:count] if count else []
+    largest = sorted(largest, key=lambda flat_idx: -magnitude[flat_idx])
+
+    worst = []
+    for flat_idx in largest:
+        orientation, pair, row, plane = np.unravel_index(
+            flat_idx, deltas.shape)
+        worst.append(comparison.pairs[pair] + (
+            ['horz', 'vert'][orientation],
+            comparison.freqs[pair, row],
+            comparison.defocus[plane],
+            deltas[orientation, pair, row, plane]))
+
+    return worst
+
+
+def iter_comparison_report(comparison, count=10):
+    """
+    Generator stage that yields a lot comparison as rows of strings, e.g. for
+    ``write_output_data``: the distribution of all the differences, the
+    worst deviations, and the unmatched files.
+
+    Parameters
+    ==========
+    comparison : LotComparison
+        the output of ``compare_lots``
+
+    count : integer (optional)
+        number of worst deviations to list
+    """
+    deltas = np.concatenate([
+        comparison.horz.ravel(), comparison.vert.ravel()])
+    deltas = deltas[~np.isnan(deltas)]
+
+    yield ['matched files', str(len(comparison.pairs))]
+    if len(deltas):
+        yield ['mean delta (% MTF)', '%.2f' % deltas.mean()]
+        yield ['std delta (% MTF)', '%.2f' % deltas.std()]
+        for percent in (0, 5, 25, 50, 75, 95, 100):
+            yield ['percentile %d (%% MTF)' % percent,
+                   '%.2f' % np.percentile(deltas, percent)]
+
+    yield ['reference', 'test', 'orientation', 'freq (lp/mm)',
+           'defocus (um)', 'delta (% MTF)']
+    for reference_path, test_path, orientation, freq, defocus, delta in \
+            worst_deviations(comparison, count):
+        yield [os.path.basename(reference_path), os.path.basename(test_path),
+               orientation, '%g' % freq, '%.2f' % defocus, '%.2f' % delta]
+
+    for path in comparison.unmatched:
+        yield ['unmatched', path]
+
+
+def field_angles(stack, by='auto', pattern=_FIELD_ANGLE_PATTERN):
+    """
+    Returns the signed field angle of every file in a stack.
+
+    Parameters
+    ==========
+    stack : THFStack
+
+    by : string (optional)
+        'header' to use the "Field Angle:" header field, 'name' to find the
+        angle in the file name with "pattern", or 'auto' (the default) to use
+        the header unless it is the same for every file or missing for any
+        file (i.e. it was not filled in), and the file name otherwise.
+
+    pattern : string (optional)
+        regular expression whose first group is the signed angle; the default
+        matches names such as "+14 degrees.thf".  Files whose names do not
+        match are taken as on-axis (0 degrees).
+
+    Returns
+    =======
+    angles : 1D array of floats
+        the field angle of each file, in degrees
+    """
+    header_values = stack.headers.get('Field Angle', [''] * len(stack.paths))
+    header_angles = np.array(
+        [float(value or 'nan') for value in header_values])
+
+    # (Check for NaN first: older versions of np.unique do not merge NaNs)
+    if by == 'header' or (
+            by == 'auto' and not np.isnan(header_angles).any() and
+            len(np.unique(header_angles)) > 1):
+        return header_angles
+
+    angles = np.zeros(len(stack.paths))
+    for idx, path in enumerate(stack.paths):
+        match = re.search(pattern, os.path.basename(path), re.I)
+        if match:
+            angles[idx] = float(match.group(1))
+
+    return angles
+
+
+def field_group_stats(
+        stack, orientation='avg', by='auto', pattern=_FIELD_ANGLE_PATTERN,
+        grid=None):
+    """
+    Groups the files in a stack by the magnitude of their field angle (e.g.
+    +14 and -14 degrees together, on-axis files together) and computes the
+    statistics of each group at every frequency and defocus plane.
+
+    The files of each group are resampled onto the group's own defocus grid
+    (see ``common_defocus_grid``), so that a group measured with fine plane
+    spacing is not coarsened by the other groups.  The statistics of all the
+    groups are then computed at once with ``reduceat`` over the files sorted
+    by group.
+
+    Parameters
+    ==========
+    stack : THFStack
+        e.g. the output of ``stack_THF_files``
+
+    orientation : string (optional)
+        'horz', 'vert', or 'avg' (the default)
+
+    by, pattern : strings (optional)
+        how to find the field angles; see ``field_angles``
+
+    grid : 1D array of floats (optional)
+        one defocus grid for every group, instead of a grid per group; see
+        ``resample_defocus``
+
+    Returns
+    =======
+    groups : FieldGroups
+        ``(angles, paths, freqs, defocus, mean, asymmetry, worst)``, where
+
+        #. ``angles`` -- 1D array of the field angle magnitude of each group
+        #. ``paths`` -- list of the file paths in each group
+        #. ``freqs`` -- (groups x freqs) spatial frequencies
+        #. ``defocus`` -- (groups x planes) defocus grid of each group,
+           NaN-padded
+        #. ``mean`` -- (groups x freqs x planes) mean MTF of the group
+        #. ``asymmetry`` -- (groups x freqs x planes) absolute difference
+           between the mean MTF of the +angle and the -angle files (NaN if
+           the group does not have both)
+        #. ``worst`` -- (groups x freqs x planes) lowest MTF in the group
+
+    See Also
+    ========
+    field_angles, plot_field_groups
+    """
+    angles = field_angles(stack, by, pattern)
+    defocus = np.asarray(stack.defocus, dtype=float)
+
+    if orientation == 'avg':
+        MTF = (np.asarray(stack.horz, dtype=float) +
+               np.asarray(stack.vert, dtype=float))/2.0
+    else:
+        MTF = np.asarray(getattr(stack, orientation), dtype=float)
+
+    # Sort the files by group, so that each group is one run of files
+    magnitude = np.round(np.abs(angles), 2)
+    order = np.argsort(magnitude, kind='mergesort')
+    group_angles, starts = np.unique(magnitude[order], return_index=True)
+    group_of_file = np.searchsorted(group_angles, magnitude[order])
+
+    # Resample each group onto its own grid, then pad the groups to the
+    # same number of planes
+    grids = []
+    group_data = []
+    for files in np.split(order, starts[1:]):
+        group_grid = grid
+        if group_grid is None:
+            group_grid = common_defocus_grid(
+                stack._replace(defocus=defocus[files]))
+        group_grid = np.asarray(group_grid, dtype=float)
+        grids.append(group_grid)
+        group_data.append(_interp_planes(
+            defocus[files], MTF[files], group_grid,
+            _plane_tolerance(defocus[files])))
+
+    n_planes = max(len(group_grid) for group_grid in grids)
+    data = np.full(MTF.shape[:2] + (n_planes,), np.nan)
+    for start, values in zip(starts, group_data):
+        data[start:start + len(values), :, :values.shape[2]] = values
+    valid = ~np.isnan(data)
+    values = np.where(valid, data, 0.0)
+    side = np.sign(angles[order])[:, np.newaxis, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.add.reduceat(values, starts) / \
+            np.add.reduceat(valid.astype(int), starts)
+
+        # Mean of the +angle and of the -angle files of each group
+        side_means = []
+        for sign in (1, -1):
+            in_side = valid & (side == sign)
+            side_means.append(
+                np.add.reduceat(np.where(in_side, data, 0.0), starts) /
+                np.add.reduceat(in_side.astype(int), starts))
+
+    paths = [[] for angle in group_angles]
+    for idx, group in zip(order, group_of_file):
+        paths[group].append(stack.paths[idx])
+
+    return FieldGroups(
+        group_angles,
+        paths,
+        np.asarray(stack.freqs, dtype=float)[order][starts],
+        _pad_stack(grids),
+        mean,
+        np.abs(side_means[0] - side_means[1]),
+        np.fmin.reduceat(data, starts))
+
+
+def plot_field_groups(
+        selected_dir, plots_down, main_title, freqs, spec_lines, colors,
+        maximize_plot, by='auto', skip_duplicates=False, workers=None,
+        dtype=float):
+    """
+    For a given directory with ``.thf`` files, group the files by the
+    magnitude of their field angle and plot each group as one panel: the
+    mean (solid), the worst case (dashed), and the +/- asymmetry (dotted) of
+    the average MTF at the given frequency(s).
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to the folder containing the ``.thf`` files to plot (or an
+        archive or MTF store)
+
+    plots_down, main_title, freqs, spec_lines, maximize_plot
+        see ``plot_all``
+
+    colors : list of strings
+        one color per frequency
+
+    by : string (optional)
+        how to find the field angles; see ``field_angles``
+
+    skip_duplicates : boolean (optional)
+        If true, then duplicated files count only once in the group
+        statistics; see ``plot_all``.
+
+    workers, dtype : (optional)
+        see ``plot_all``
+
+    Returns
+    =======
+    output : Displays a plot
+        One subplot per group of field positions.
+
+    skipped : list of tuples
+        ``(path, reason)`` for each file that was skipped (unreadable, or a
+        duplicate); they are also printed.  If no file can be plotted, then
+        a NoTHFFilesError listing them is raised instead.
+
+    See Also
+    ========
+    field_group_stats, plot_all
+    """
+    quarantine = []
+    duplicates = [] if skip_duplicates else None
+    try:
+        stack = stack_THF_files(selected_dir, dtype, quarantine, duplicates,
+                                numeric_only=True, workers=workers)
+    except NoTHFFilesError:
+        raise _no_files_error(
+            selected_dir, _report_skipped(quarantine, duplicates))
+    groups = field_group_stats(stack, by=by)
+    freqs_sorted = _sorted_floats(freqs)
+    specs_sorted = _sorted_floats(spec_lines)
+
+    plots_down, plots_across = _subplot_layout(len(groups.angles), plots_down)
+
+    figure = _new_figure(maximize_plot)
+
+    for idx, angle in enumerate(groups.angles):
+        plt.subplot(plots_down, plots_across, idx + 1)
+
+        for n, freq in enumerate(freqs_sorted):
+            rows = np.flatnonzero(groups.freqs[idx] == freq)
+            if len(rows) == 0:
+                continue
+            label = 'at ' + str(freq) + ' lp/mm'
+            plt.plot(groups.defocus[idx], groups.mean[idx, rows[0]], '-',
+                     linewidth=1, c=colors[n], label='mean ' + label)
+            plt.plot(groups.defocus[idx], groups.worst[idx, rows[0]], '--',
+                     linewidth=1, c=colors[n], label='worst ' + label)
+            plt.plot(groups.defocus[idx], groups.asymmetry[idx, rows[0]],
+                     ':', linewidth=1, c=colors[n],
+                     label='asymmetry ' + label)
+
+        # Title, y-axis limits, axis labels
+        plt.title(
+            '%g degrees (%d files)' % (angle, len(groups.paths[idx])),
+            fontsize=12, fontweight='bold')
+        plt.ylim((0, 100))
+        plt.xlabel('defocus position (um)')
+        plt.ylabel('% MTF')
+        ax = plt.gca()  # get current axes
+        plt.setp(ax.get_xticklabels(), fontsize=10, rotation='vertical')
+        plt.setp(ax.get_yticklabels(), fontsize=10)
+
+        # Plot spec lines as horizontal, black, dotted lines
+        for spec in specs_sorted:
+            plt.axhline(spec, color='k', linestyle=':')
+
+    # Add one master legend
+    plt.legend(
+        bbox_to_anchor=(1.02, 1.0), loc='upper left',
+        borderaxespad=0, fontsize=10)
+
+    # Tweak subplot spacing
+    plt.subplots_adjust(hspace=0.7, wspace=0.3)
+
+    _add_suptitle(figure, main_title, selected_dir)
+
+    skipped = _report_skipped(quarantine, duplicates)
+
+    plt.show()
+
+    return skipped
+
+
+def best_focus_curves(
+        stack, orientation='avg', ref_freq=None, offsets=(0,),
+        interpolate=False):
+    """
+    MTF as a function of spatial frequency at each file's best focus, and
+    at defocus offsets from it, for every file in a stack at once.
+
+    The best-focus plane of every file is found with one ``argmax`` over the
+    stacked (files x freqs x planes) tables, and the curves are picked out
+    of the stack with fancy indexing, so there is no loop over the files.
+
+    Parameters
+    ==========
+    stack : THFStack
+        e.g. the output of ``stack_THF_files``
+
+    orientation : string (optional)
+        'horz', 'vert', or 'avg'
+
+    ref_freq : float (optional)
+        Spatial frequency (lp/mm) whose MTF peak defines best focus.  If not
+        given, then best focus is the plane with the highest mean MTF over
+        all the frequencies.
+
+    offsets : 1D list of floats (optional)
+        defocus positions (microns) relative to best focus at which to take
+        the curves; 0 is best focus itself
+
+    interpolate : boolean (optional)
+        If true, then best focus is refined between planes (with a parabola
+        through the peak plane and its neighbors) and the curves are
+        linearly interpolated between the planes around each position.
+        Otherwise, the nearest plane is used.
+
+    Returns
+    =======
+    curves : FocusCurves
+        #. ``paths`` -- the ``.thf`` paths
+        #. ``freqs`` -- (files x freqs) spatial frequencies, NaN-padded
+        #. ``offsets`` -- the defocus offsets
+        #. ``best_focus`` -- (files) defocus position of best focus
+        #. ``MTF`` -- (files x offsets x freqs) MTF; NaN where the position
+           is outside the file's defocus range
+
+    See Also
+    ========
+    plot_best_focus_curves, iter_best_focus_output
+    """
+    if orientation == 'avg':
+        data = (np.asarray(stack.horz, dtype=float) +
+                np.asarray(stack.vert, dtype=float))/2.0
+    else:
+        data = np.asarray(getattr(stack, orientation), dtype=float)
+    defocus = np.asarray(stack.defocus, dtype=float)
+    offsets = np.asarray(offsets, dtype=float).ravel()
+
+    n_files = len(stack.paths)
+    rows = np.arange(n_files)[:, np.newaxis]
+    n_valid = np.count_nonzero(~np.isnan(defocus), axis=1)[:, np.newaxis]
+
+    # One argmax over the planes of every file; NaN never wins
+    if ref_freq is None:
+        valid = ~np.isnan(data)
+        with np.errstate(invalid='ignore'):
+            score = np.where(valid, data, 0.0).sum(axis=1) / \
+                valid.sum(axis=1)
+    else:
+        score = _MTF_at_freq(stack, ref_freq, orientation)
+    score = np.where(np.isnan(score), -np.inf, score)
+    peak = score.argmax(axis=1)[:, np.newaxis]
+    best_focus = defocus[rows, peak]
+
+    if interpolate:
+        # Vertex of the parabola through the peak plane and its neighbors
+        inside = (peak > 0) & (peak < n_valid - 1)
+        below = np.where(inside, peak - 1, peak)
+        above = np.where(inside, peak + 1, peak)
+        y0, y1, y2 = score[rows, below], score[rows, peak], score[rows, above]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift = 0.5*(y0 - y2)/(y0 - 2*y1 + y2)
+        shift = np.where(inside & np.isfinite(shift), shift, 0.0)
+        step = np.where(shift < 0, best_focus - defocus[rows, below],
+                        defocus[rows, above] - best_focus)
+        best_focus = best_focus + np.clip(shift, -1, 1)*step
+
+    # Plane interval (or nearest plane) of every position in every file
+    positions = best_focus + offsets
+    planes = np.where(np.isnan(defocus), np.inf, defocus)
+    last = defocus[rows, n_valid - 1]
+    with np.errstate(invalid='ignore'):
+        outside = (positions < defocus[:, :1]) | (positions > last)
+    if interpolate:
+        idx = (planes[:, np.newaxis, :] <= positions[:, :, np.newaxis]).sum(
+            axis=2) - 1
+        idx = np.clip(idx, 0, np.maximum(n_valid - 2, 0))
+        x0 = defocus[rows, idx]
+        x1 = defocus[rows, np.minimum(idx + 1, n_valid - 1)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(x1 > x0, (positions - x0)/(x1 - x0), 0.0)
+    else:
+        idx = np.abs(
+            planes[:, np.newaxis, :] - positions[:, :, np.newaxis]).argmin(
+                axis=2)
+        weight = np.zeros(idx.shape)
+
+    # Bring the planes axis next to the files axis for the fancy indexing
+    planes_first = np.moveaxis(data, -1, 1)
+    y0 = planes_first[rows, idx]
+    y1 = planes_first[rows, np.minimum(idx + 1, n_valid - 1)]
+    MTF = y0 + weight[:, :, np.newaxis]*(y1 - y0)
+    MTF[outside] = np.nan
+
+    return FocusCurves(
+        stack.paths, np.asarray(stack.freqs, dtype=float), offsets,
+        best_focus.ravel(), MTF)
+
+
+def iter_best_focus_output(curves, slicename='avg'):
+    """
+    Generator stage that turns ``best_focus_curves`` into named rows for
+    ``write_output_data``.
+
+    Parameters
+    ==========
+    curves : FocusCurves
+        e.g. the output of ``best_focus_curves``
+
+    slicename : string (optional)
+        orientation of the curves, used in the row names
+
+    Returns
+    =======
+    output : generator of lists
+        For each file, the best-focus position, the frequencies, and one row
+        of MTF per offset, each with its name as the first entry.
+
+    See Also
+    ========
+    best_focus_curves, write_output_data
+    """
+    for idx, path in enumerate(curves.paths):
+        filename = os.path.basename(path)[:-4]  # removes ".thf"
+        n_freqs = np.count_nonzero(~np.isnan(curves.freqs[idx]))
+
+        yield [filename + ' best focus (um)', str(curves.best_focus[idx])]
+        yield [filename + ' freq (lp/mm)'] + [
+            str(number) for number in curves.freqs[idx, :n_freqs].tolist()]
+        for k, offset in enumerate(curves.offsets):
+            MTF = curves.MTF[idx, k, :n_freqs]
+            yield ['%s %% MTF %s at best focus %+g um' % (
+                filename, slicename, offset)] + [
+                str(number) for number in MTF.tolist()]
+
+
+def plot_best_focus_curves(
+        selected_dir, plots_down, main_title, offsets, spec_lines, plot_avg,
+        colors, maximize_plot, ref_freq=None, interpolate=True,
+        skip_duplicates=False, workers=None, dtype=float):
+    """
+    For a given directory with ``.thf`` files, plot the MTF as a function of
+    spatial frequency at each file's best focus (and at the given defocus
+    offsets from it), one subplot per file.
+
+    Parameters
+    ==========
+    selected_dir, plots_down, main_title, spec_lines, maximize_plot
+        see ``plot_all``
+
+    offsets : comma-separated string of defocus offsets (microns)
+        Offsets from best focus; one curve per offset.  If no value is
+        entered, then only best focus is plotted.
+
+    plot_avg : boolean
+        If true, then plot the average of the MTF.  Otherwise, plot
+        horizontal (solid) and vertical (dotted) MTF separately, each at its
+        own best focus (both are given in the subplot title).
+
+    colors : list of strings
+        one color per offset
+
+    ref_freq, interpolate
+        see ``best_focus_curves``
+
+    skip_duplicates, workers, dtype : (optional)
+        see ``plot_all``
+
+    Returns
+    =======
+    output : Displays a plot
+        One subplot per ``.thf`` file.
+
+    skipped : list of tuples
+        ``(path, reason)`` for each file that was skipped (unreadable, or a
+        duplicate); they are also printed.  If no file can be plotted, then
+        a NoTHFFilesError listing them is raised instead.
+
+    See Also
+    ========
+    best_focus_curves, plot_all
+    """
+    quarantine = []
+    duplicates = [] if skip_duplicates else None
+    try:
+        stack = stack_THF_files(selected_dir, dtype, quarantine, duplicates,
+                                numeric_only=True, workers=workers)
+    except NoTHFFilesError:
+        raise _no_files_error(
+            selected_dir, _report_skipped(quarantine, duplicates))
+    offsets_sorted = _sorted_floats(offsets)
+    if len(offsets_sorted) == 0:
+        offsets_sorted = np.zeros(1)
+    specs_sorted = _sorted_floats(spec_lines)
+
+    if plot_avg:
+        slices = [('avg', '.-')]
+    else:
+        slices = [('horz', '.-'), ('vert', '.:')]
+    all_curves = [
+        (slicename, style,
+         best_focus_curves(stack, slicename, ref_freq, offsets_sorted,
+                           interpolate))
+        for slicename, style in slices]
+
+    n_files = len(stack.paths)
+    plots_down, plots_across = _subplot_layout(n_files, plots_down)
+
+    figure = _new_figure(maximize_plot)
+
+    for idx in range(n_files):
+        plt.subplot(plots_down, plots_across, idx + 1)
+
+        for slicename, style, curves in all_curves:
+            for k, offset in enumerate(curves.offsets):
+                plt.plot(
+                    curves.freqs[idx], curves.MTF[idx, k], style,
+                    linewidth=1, c=colors[k % len(colors)],
+                    label='%s at best focus %+g um' % (slicename, offset))
+
+        # Title (with the best focus of each orientation), y-axis limits,
+        # axis labels
+        if len(all_curves) == 1:
+            best_focus = '%.1f um' % all_curves[0][2].best_focus[idx]
+        else:
+            best_focus = ', '.join(
+                '%s %.1f um' % (slicename, curves.best_focus[idx])
+                for slicename, style, curves in all_curves)
+        plt.title(
+            '%s\nbest focus %s' % (
+                os.path.basename(stack.paths[idx]), best_focus),
+            fontsize=12, fontweight='bold')
+        plt.ylim((0, 100))
+        plt.xlabel('spatial frequency (lp/mm)')
+        plt.ylabel('% MTF')
+        ax = plt.gca()  # get current axes
+        plt.setp(ax.get_xticklabels(), fontsize=10, rotation='vertical')
+        plt.setp(ax.get_yticklabels(), fontsize=10)
+
+        # Plot spec lines as horizontal, black, dotted lines
+        for spec in specs_sorted:
+            plt.axhline(spec, color='k', linestyle=':')
+
+    # Add one master legend
+    plt.legend(
+        bbox_to_anchor=(1.02, 1.0), loc='upper left',
+        borderaxespad=0, fontsize=10)
+
+    # Tweak subplot spacing
+    plt.subplots_adjust(hspace=0.7, wspace=0.3)
+
+    _add_suptitle(figure, main_title, selected_dir)
+
+    skipped = _report_skipped(quarantine, duplicates)
+
+    plt.show()
+
+    return skipped
+
+
+def _cell_edges(centers):
+    """
+    Returns the edges of cells centered on the given increasing positions
+    (halfway between neighbors, and half a step past the ends), e.g. for
+    ``pcolormesh``.
+    """
+    centers = np.asarray(centers, dtype=float)
+    if len(centers) < 2:
+        return np.concatenate((centers - 0.5, centers + 0.5))
+
+    middles = (centers[1:] + centers[:-1])/2.0
+    return np.concatenate((
+        [2*centers[0] - middles[0]], middles, [2*centers[-1] - middles[-1]]))
+
+
+def _new_figure(maximize_plot):
+    """
+    Makes a new figure at the size used by every plot.  If "maximize_plot"
+    is true (GUI mode), then the plot window is maximized.
+    """
+    figure = plt.figure(figsize=(16, 12))
+
+    if maximize_plot:
+        mng = plt.get_current_fig_manager()
+        mng.frame.Maximize(True)
+
+    return figure
+
+
+def _add_suptitle(figure, main_title, selected_dir, top=0.85):
+    """
+    Puts the title, the directory, and today's date above all the subplots,
+    and moves the subplots down to "top" (unless it is None) so that they do
+    not overlap it.
+    """
+    figure.suptitle(
+        main_title + '\n' + selected_dir + '\n' +
+        str(datetime.now().strftime('%B %d, %Y')),
+        fontsize=14, fontweight='bold')
+
+    if top is not None:
+        figure.subplots_adjust(top=top)
+
+
+def _report_skipped(quarantine, duplicates=None):
+    """
+    Prints the files that were skipped as unreadable (see ``iter_thf``) or
+    as duplicates (see ``iter_unique_paths``), and returns them all as one
+    list of ``(path, reason)`` tuples.
+    """
+    skipped = list(quarantine)
+    for path, reason in quarantine:
+        print 'skipped ' + path + ': ' + reason
+    for path, original_path in duplicates or []:
+        print 'duplicate ' + path + ': same data as ' + original_path
+        skipped.append((path, 'same data as ' + original_path))
+
+    return skipped
+
+
+def _no_files_error(selected_dir, skipped):
+    """
+    Returns the NoTHFFilesError for a directory without any file that can
+    be plotted, listing the files that were skipped.
+    """
+    message = 'No .thf files to plot in ' + selected_dir + '.'
+    if skipped:
+        message += '\n\nSkipped files:\n' + '\n'.join(
+            os.path.basename(path) + ': ' + reason
+            for path, reason in skipped)
+
+    return NoTHFFilesError(message)
+
+
+def _subplot_layout(n_plots, plots_down):
+    """
+    Returns the number of rows and columns of subplots for ``plot_all``.  See
+    the "plots_down" parameter of ``plot_all``.
+    """
+    if plots_down == '':       # if nothing is entered,
+        plots_down = 2  # then set to 2
+    # If needed, override the user-entered value of "plots_down"
+    elif n_plots == 1:  # only one file in the directory
+        plots_down = 1
+    elif n_plots < int(plots_down):  # more rows than there are plots
+        plots_down = n_plots
+    else:
+        plots_down = int(plots_down)
+
+    # Calculate the "plots_across" value
+    plots_across = np.ceil(n_plots/float(plots_down)).astype(int)
+
+    return plots_down, plots_across
+
+
+def _sorted_floats(text):
+    """
+    Converts a comma-separated string of numbers (e.g. frequencies or spec
+    lines from the GUI) to a sorted array of floats.  An empty string gives
+    an empty array.
+    """
+    if text.strip() == '':
+        return np.ndarray([0])
+
+    return np.sort(np.asarray(text.split(',')).astype(float))
+
+
 def plot_all(
     selected_dir, plots_down, main_title, freqs, spec_lines, plot_avg,
-        same_plot, colors, maximize_plot):
+        same_plot, colors, maximize_plot, skip_duplicates=False,
+        workers=None, dtype=float):
     """
     For a given directory with ``.thf`` files and at least one spatial
     frequency, plot all the data from the ``.thf`` files at the given
@@ -446,46 +2971,70 @@ def plot_all(
         If true, then maximize the plot window.  This is used in the wxPython
         GUI only.
 
+    skip_duplicates : boolean (optional)
+        If true, then files with the same MTF data as an earlier file (even
+        if their headers differ) are plotted only once and listed at the
+        end; see ``iter_unique_paths``.
+
+    workers : integer (optional)
+        If given, then all the files are read up front by this many worker
+        processes into one shared-memory stack (see ``stack_THF_files``),
+        instead of one at a time while they are plotted.  Each file is then
+        copied out of the stack for plotting, so this saves parsing time,
+        not memory.
+
+    dtype : numpy dtype (optional)
+        float type of that stack while it is read; only used with
+        "workers".  The plotted data is float64 either way.
+
     Returns
     =======
     output : Displays a plot
         A plot is produced with each ``.thf`` path as its own subplot.  There
-        can be multiple spatial frequencies on each subplot.
+        can be multiple spatial frequencies on each subplot.  Files that are
+        not through-focus MTF files or that cannot be read are skipped and
+        listed at the end instead of stopping the whole run.
+
+    skipped : list of tuples
+        ``(path, reason)`` for each file that was skipped (unreadable, or a
+        duplicate); they are also printed.  If no file can be plotted, then
+        a NoTHFFilesError listing them is raised instead.
     """
-    all_paths = get_all_file_paths(selected_dir)  # get all paths
-
-    # Establish the value of "plots_down".
-    if plots_down == '':       # if nothing is entered,
-        plots_down = 2  # then set to 2
-    # If needed, override the user-entered value of "plots_down"
-    elif len(all_paths) == 1:  # only one file in the directory
-        plots_down = 1
-    elif len(all_paths) < int(plots_down):  # more rows than there are plots
-        plots_down = len(all_paths)
+    # Get all paths, but set aside the files that are obviously not
+    # through-focus MTF files; files that fail later are set aside too
+    quarantine = []
+    duplicates = []
+    all_paths = []
+    records = {}  # path -> THFRecord, if the files were read up front
+    if workers:
+        for record in _stacked_records(
+                selected_dir, dtype, quarantine,
+                duplicates if skip_duplicates else None, workers):
+            all_paths.append(record.path)
+            records[record.path] = record
     else:
-        plots_down = int(plots_down)
-
-    # Calculate the "plots_across" value
-    plots_across = np.ceil(len(all_paths)/float(plots_down)).astype(int)
+        paths = iter_file_paths(selected_dir)
+        if skip_duplicates:
+            paths = iter_unique_paths(paths, True, duplicates)
+        for path in paths:
+            reason = sniff_THF_file(path)
+            if reason is None:
+                all_paths.append(path)
+            else:
+                quarantine.append((path, reason))
 
-    # Sort the frequencies +++ WORK +++
-    freqs_sorted = np.sort(np.asarray(freqs.split(',')).astype(float))
+    if not all_paths:
+        raise _no_files_error(
+            selected_dir, _report_skipped(quarantine, duplicates))
 
-    # Sort the spec lines
-    if spec_lines == '':                # if nothing is entered,
-        specs_sorted = np.ndarray([0])  # then set to 0
-    else:
-        specs_sorted = np.sort(
-            np.asarray(spec_lines.split(',')).astype(float))
+    # Establish the values of "plots_down" and "plots_across"
+    plots_down, plots_across = _subplot_layout(len(all_paths), plots_down)
 
-    # Set the figure size before plotting
-    plt.figure(figsize=(16, 12))
+    # Sort the frequencies and the spec lines +++ WORK +++
+    freqs_sorted = _sorted_floats(freqs)
+    specs_sorted = _sorted_floats(spec_lines)
 
-    # If in GUI mode, maximize the plot window
-    if maximize_plot:
-        # plt.switch_backend('wxAgg')
-        mng = plt.get_current_fig_manager()
-        mng.frame.Maximize(True)
+    figure = _new_figure(maximize_plot)
 
     # Plot the requested data
     if same_plot:  # plot all curves on the same plot
@@ -494,18 +3043,25 @@ def plot_all(
                 title = 'Average % MTF of overlapping corridors'
             else:
                 title = 'Horz and vert % MTF of overlapping corridors'
-            plot_one_THF_file(
-                current_path, title, freqs_sorted, specs_sorted,
-                plot_avg, colors)
+            try:
+                plot_one_THF_file(
+                    current_path, title, freqs_sorted, specs_sorted,
+                    plot_avg, colors, records.get(current_path))
+            except ValueError as error:
+                quarantine.append((current_path, str(error)))
 
     else:  # loop through the files and plot separately
         subplot_idx = 1
         for current_path in all_paths:
             title = os.path.basename(current_path)  # get the file name
             plt.subplot(plots_down, plots_across, subplot_idx)  # set supblot
-            plot_one_THF_file(
-                current_path, title, freqs_sorted, specs_sorted, plot_avg,
-                colors)
+            try:
+                plot_one_THF_file(
+                    current_path, title, freqs_sorted, specs_sorted,
+                    plot_avg, colors, records.get(current_path))
+            except ValueError as error:
+                quarantine.append((current_path, str(error)))
+                plt.title(title + ' (skipped)', fontsize=12)
             subplot_idx += 1
 
         # Add one master legend
@@ -517,20 +3073,374 @@ def plot_all(
         # Tweak subplot spacing
         plt.subplots_adjust(hspace=0.7, wspace=0.3)
 
-    # Concatenate the plot supertitle
-    plt.suptitle(
-        main_title + '\n' + selected_dir + '\n' +
-        str(datetime.now().strftime('%B %d, %Y')),
-        fontsize=14, fontweight='bold')
+    # Files can also fail while they are plotted
+    skipped_paths = set(path for path, reason in quarantine)
+    if all(path in skipped_paths for path in all_paths):
+        plt.close(figure)
+        raise _no_files_error(
+            selected_dir, _report_skipped(quarantine, duplicates))
 
-    # Adjust the spacing so suptitle won't overlap the plots
-    plt.subplots_adjust(top=0.85)
+    _add_suptitle(figure, main_title, selected_dir)
+
+    skipped = _report_skipped(quarantine, duplicates)
 
     plt.show()
 #    plt.close(fig)
 
     print 'done!'
 
+    return skipped
+
+
+def plot_MTF_heatmaps(
+        selected_dir, plots_down, main_title, spec_lines, maximize_plot,
+        workers=None, dtype=float):
+    """
+    For a given directory with ``.thf`` files, plot the complete MTF table
+    (frequency x defocus position) of every file as images, with contour
+    lines at the spec levels.
+
+    Each orientation of each file is a single image instead of one line per
+    frequency.  All the images share one color scale, which is computed from
+    the whole stack at once.
+
+    Parameters
+    ==========
+    selected_dir : string
+        path to the folder containing the ``.thf`` files to plot (or an
+        archive or MTF store)
+
+    plots_down : integer
+        Number of rows of files; see ``plot_all``.  Each file takes two
+        subplots side by side (horz and vert).
+
+    main_title : string
+        Super-title above all the subplots
+
+    spec_lines : comma-separated string of desired spec lines
+        The MTF levels at which to draw black contour lines.  If no value is
+        entered, then no contours are drawn.
+
+    maximize_plot : boolean
+        If true, then maximize the plot window.  This is used in the wxPython
+        GUI only.
+
+    workers, dtype : (optional)
+        see ``plot_all``
+
+    Returns
+    =======
+    output : Displays a plot
+        Two images (horz and vert) per ``.thf`` file.
+
+    skipped : list of tuples
+        ``(path, reason)`` for each file that was skipped (unreadable, or a
+        duplicate); they are also printed.  If no file can be plotted, then
+        a NoTHFFilesError listing them is raised instead.
+
+    See Also
+    ========
+    plot_all
+    """
+    quarantine = []
+    try:
+        stack = stack_THF_files(selected_dir, dtype, quarantine,
+                                workers=workers)
+    except NoTHFFilesError:
+        raise _no_files_error(selected_dir, _report_skipped(quarantine))
+    specs_sorted = _sorted_floats(spec_lines)
+    n_files = len(stack.paths)
+
+    plots_down, plots_across = _subplot_layout(n_files, plots_down)
+
+    # One color scale for every image, from the whole stack at once
+    norm = matplotlib.colors.Normalize(
+        vmin=np.nanmin([np.nanmin(stack.horz), np.nanmin(stack.vert)]),
+        vmax=np.nanmax([np.nanmax(stack.horz), np.nanmax(stack.vert)]))
+
+    # Number of frequencies and planes of each file, without the NaN padding
+    all_n_freqs = np.count_nonzero(~np.isnan(stack.freqs), axis=1)
+    all_n_planes = np.count_nonzero(~np.isnan(stack.defocus), axis=1)
+
+    fig = _new_figure(maximize_plot)
+
+    all_axes = []
+    for idx in range(n_files):
+        n_freqs, n_planes = all_n_freqs[idx], all_n_planes[idx]
+        freqs = stack.freqs[idx, :n_freqs]
+        defocus = stack.defocus[idx, :n_planes]
+        filename = os.path.basename(stack.paths[idx])
+        row, col = divmod(idx, plots_across)
+
+        for n, slicename in enumerate(['horz', 'vert']):
+            table = getattr(stack, slicename)[idx, :n_freqs, :n_planes]
+            ax = plt.subplot(
+                plots_down, 2*plots_across, 2*(row*plots_across + col) + n + 1)
+            # One cell per sample, centered on its (possibly uneven)
+            # position, so that the cells line up with the contours
+            image = ax.pcolormesh(
+                _cell_edges(defocus), _cell_edges(freqs), table, norm=norm)
+
+            # Contour lines at the spec levels
+            if len(specs_sorted) > 0:
+                contours = ax.contour(
+                    defocus, freqs, table, levels=specs_sorted, colors='k',
+                    linestyles=':', linewidths=1)
+                ax.clabel(contours, fontsize=8, fmt='%g')
+
+            ax.set_title(filename + ' ' + slicename, fontsize=10,
+                         fontweight='bold')
+            ax.set_xlabel('defocus position (um)')
+            ax.set_ylabel('freq (lp/mm)')
+            plt.setp(ax.get_xticklabels(), fontsize=8, rotation='vertical')
+            plt.setp(ax.get_yticklabels(), fontsize=8)
+            all_axes.append(ax)
+
+    # Tweak subplot spacing
+    plt.subplots_adjust(hspace=0.7, wspace=0.4)
+
+    # One shared color bar
+    fig.colorbar(image, ax=all_axes, label='% MTF')
+
+    # The color bar takes the space on the right, so keep the spacing
+    _add_suptitle(fig, main_title, selected_dir, top=None)
+
+    skipped = _report_skipped(quarantine)
+
+    plt.show()
+
+    return skipped
+
+
+class MTFFigure(object):
+    """
+    A ``plot_all`` figure that keeps its parsed data and line artists alive,
+    so that the frequencies, ``plot_avg``, and the spec lines can be changed
+    with ``update`` without re-parsing the files or rebuilding the figure.
+
+    All the lines are animated artists: ``update`` only changes their data
+    and visibility and then blits them over a saved background, so it stays
+    fast with hundreds of files.  Lines are made the first time they are
+    needed and then reused.
+
+    The constructor takes the same parameters as ``plot_all``, but without
+    blocking.
+
+    Attributes
+    ==========
+    records : list of THFRecord
+        the parsed data (full tables) of every file in the directory
+
+    quarantine : list of tuples
+        ``(path, reason)`` for each file that was skipped
+
+    duplicates : list of tuples
+        ``(path, original_path)`` for each file that was left out as a
+        duplicate (only if ``skip_duplicates`` is true)
+
+    skipped : list of tuples
+        ``(path, reason)`` for both of the above; see ``plot_all``
+
+    figure : matplotlib.figure.Figure
+    """
+    def __init__(
+        self, selected_dir, plots_down, main_title, freqs, spec_lines,
+            plot_avg, same_plot, colors, maximize_plot,
+            skip_duplicates=False, workers=None, dtype=float):
+        self.quarantine = []
+        self.duplicates = []
+        duplicates = self.duplicates if skip_duplicates else None
+        if workers:
+            self.records = _stacked_records(
+                selected_dir, dtype, self.quarantine, duplicates, workers)
+        else:
+            self.records = list(iter_thf(
+                selected_dir, quarantine=self.quarantine,
+                duplicates=duplicates, numeric_only=True))
+        if not self.records:
+            raise _no_files_error(
+                selected_dir,
+                _report_skipped(self.quarantine, self.duplicates))
+        self.same_plot = same_plot
+        self.colors = colors
+        self.lines = {}         # (file idx, freq, slicename) -> Line2D
+        self.spec_artists = {}  # axes -> list of Line2D
+        self.legend = None
+        self.background = None
+
+        self.figure = _new_figure(maximize_plot)
+
+        if same_plot:  # plot all curves on the same plot
+            ax = self.figure.add_subplot(1, 1, 1)
+            self.axes = [ax]*len(self.records)
+        else:  # one subplot per file
+            rows, cols = _subplot_layout(len(self.records), plots_down)
+            self.axes = [
+                self.figure.add_subplot(rows, cols, idx + 1)
+                for idx in range(len(self.records))]
+            for ax, record in zip(self.axes, self.records):
+                ax.set_title(
+                    os.path.basename(record.path), fontsize=12,
+                    fontweight='bold')
+
+            # Tweak subplot spacing
+            self.figure.subplots_adjust(hspace=0.7, wspace=0.3)
+
+        # Y-axis limits, axis labels, and the defocus range as the x-axis;
+        # the limits are fixed, since the lines are not there yet
+        for ax in set(self.axes):
+            defocus = np.concatenate([
+                record.defocus
+                for record, record_ax in zip(self.records, self.axes)
+                if record_ax is ax])
+            ax.set_xlim((defocus.min(), defocus.max()))
+            ax.set_ylim((0, 100))
+            ax.set_xlabel('defocus position (um)')
+            ax.set_ylabel('% MTF')
+            plt.setp(ax.get_xticklabels(), fontsize=10, rotation='vertical')
+            plt.setp(ax.get_yticklabels(), fontsize=10)
+
+        _add_suptitle(self.figure, main_title, selected_dir)
+
+        # Save a clean background every time the whole figure is drawn
+        self.figure.canvas.mpl_connect('draw_event', self._on_draw)
+
+        self.update(freqs, spec_lines, plot_avg)
+
+        self.skipped = _report_skipped(self.quarantine, self.duplicates)
+
+        plt.show(block=False)
+
+    def update(self, freqs, spec_lines, plot_avg):
+        """
+        Shows the MTF at new frequencies, with new spec lines, or as the
+        average instead of horz and vert (or back again).
+
+        Parameters
+        ==========
+        freqs : comma-separated string of desired spatial frequencies
+
+        spec_lines : comma-separated string of desired spec lines
+
+        plot_avg : boolean
+            If true, then plot the average of the MTF.  Otherwise, plot
+            horizontal and vertical MTF separately.
+        """
+        freqs_sorted = _sorted_floats(freqs)
+        specs_sorted = _sorted_floats(spec_lines)
+        slicenames = ['avg'] if plot_avg else ['horz', 'vert']
+
+        # Hide everything, then show (or make) only the requested lines
+        for line in self.lines.values():
+            line.set_visible(False)
+
+        for idx, record in enumerate(self.records):
+            for n, freq in enumerate(freqs_sorted):
+                for slicename in slicenames:
+                    line = self._get_line(idx, freq, slicename)
+                    if line is not None:
+                        line.set_color(self.colors[n])
+                        line.set_visible(True)
+
+        # Reuse the spec lines of each axes; make more only if needed
+        for ax in set(self.axes):
+            artists = self.spec_artists.setdefault(ax, [])
+            while len(artists) < len(specs_sorted):
+                artists.append(
+                    ax.axhline(0, color='k', linestyle=':', animated=True))
+            for m, artist in enumerate(artists):
+                artist.set_visible(m < len(specs_sorted))
+                if m < len(specs_sorted):
+                    artist.set_ydata([specs_sorted[m], specs_sorted[m]])
+
+        if self.same_plot:
+            if plot_avg:
+                title = 'Average % MTF of overlapping corridors'
+            else:
+                title = 'Horz and vert % MTF of overlapping corridors'
+            self.axes[0].set_title(title, fontsize=12, fontweight='bold')
+            self.axes[0].title.set_animated(True)
+
+        else:  # one master legend for the lines of the last subplot
+            handles = [
+                line for key, line in sorted(self.lines.items())
+                if key[0] == len(self.records) - 1 and line.get_visible()]
+            self.legend = self.axes[-1].legend(
+                handles, [line.get_label() for line in handles],
+                bbox_to_anchor=(1.02, 1.0), loc='upper left',
+                borderaxespad=0, fontsize=10)
+            self.legend.set_animated(True)
+
+        self._blit()
+
+    def _get_line(self, idx, freq, slicename):
+        """
+        Returns the line of file number "idx" at "freq", making it on first
+        use.  Returns None if the file has no data at "freq".
+        """
+        key = (idx, freq, slicename)
+        if key not in self.lines:
+            record = self.records[idx]
+            rows = np.flatnonzero(record.horz[:, 0] == freq)
+            if len(rows) == 0:
+                return None
+
+            horz, vert = record.horz[rows[0]], record.vert[rows[0]]
+            if slicename == 'avg':
+                input_array = np.add(horz, vert)/2
+            elif slicename == 'horz':
+                input_array = horz
+            else:
+                input_array = vert
+
+            name = flatten_and_name_array(
+                record.path, slicename, input_array)[0]
+            style = '.:' if slicename == 'vert' else '.-'
+            self.lines[key], = self.axes[idx].plot(
+                record.defocus, input_array[1:], style, linewidth=1,
+                label=name, animated=True)
+
+        return self.lines[key]
+
+    def _on_draw(self, event):
+        """
+        Saves the background (everything but the animated artists) after a
+        full draw, e.g. when the window is resized, and draws the animated
+        artists on top of it.
+        """
+        canvas = self.figure.canvas
+        self.background = canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        """
+        Draws the visible lines, spec lines, title, and legend.
+        """
+        for line in self.lines.values():
+            if line.get_visible():
+                line.axes.draw_artist(line)
+        for ax, artists in self.spec_artists.items():
+            for artist in artists:
+                if artist.get_visible():
+                    ax.draw_artist(artist)
+        if self.same_plot:
+            self.axes[0].draw_artist(self.axes[0].title)
+        if self.legend is not None:
+            self.axes[-1].draw_artist(self.legend)
+
+    def _blit(self):
+        """
+        Redraws only the animated artists over the saved background.
+        """
+        canvas = self.figure.canvas
+        if self.background is None:  # nothing saved yet; draw it all once
+            canvas.draw()
+            return
+
+        canvas.restore_region(self.background)
+        self._draw_animated()
+        canvas.blit(self.figure.bbox)
+
 # -----------------------------------------------------------------------------
 
 # Testing
@@ -0,0 +1,409 @@
+"""
+A small local HTTP service that processes folders (or archives, or MTF
+stores) of ``.thf`` files in batch and answers with JSON.
+
+Start it with ``python serve_THF_files.py --port 8080`` and post jobs to
+``http://localhost:8080/jobs``, e.g. with ``request_job``.  A job is a JSON
+object::
+
+    {"path": "C:/data/lot 7", "output": "metrics", "freqs": [50, 100],
+     "plot_avg": false, "rules": "avg 50 40 -50 50; avg 100 25"}
+
+Only "path" is required.  "output" is one of "metrics" (peak MTF and best
+focus per file and frequency, plus the spec yield if "rules" are given),
+"export" (the rows written by ``write_output_data``), or "png" (one
+base64-encoded PNG plot per file, keyed by its path in the lot, e.g.
+``sub/a.thf``).  A bad job (e.g. a "path" that does not exist) is answered
+with status 400 and ``{"error": "..."}``.
+
+Files are parsed on a pool of worker processes.  Parsed files are cached by
+the hash of their contents, so a file that was already parsed (even under
+another name or in another folder) is not parsed again, and a job that was
+already answered for the same file contents is answered from the cache.
+"""
+import os
+import io
+import json
+import base64
+import numbers
+import argparse
+import threading
+import multiprocessing
+from collections import OrderedDict
+import matplotlib
+matplotlib.use('Agg')  # no windows; plots are rendered to PNG
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib2 import Request, urlopen, HTTPError
+import process_THF_file  # the custom module for this project
+
+_OUTPUTS = ('metrics', 'export', 'png')
+
+
+def _hash_worker(path):
+    """
+    Worker for ``THFService``: hashes one ``.thf`` file in a separate
+    process.  Returns ``(path, digest, reason)``.
+    """
+    try:
+        return path, process_THF_file.hash_THF_file(path), None
+    except EnvironmentError as error:
+        return path, None, str(error)
+
+
+def _read_worker(args):
+    """
+    Worker for ``THFService``: reads one ``.thf`` file in a separate
+    process.  Returns ``(path, record, reason)``.
+    """
+    path, freqs = args
+    record, reason = process_THF_file.try_read_THF_file(path, freqs)
+    return path, record, reason
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class THFService(object):
+    """
+    Runs batch jobs on folders of ``.thf`` files, with a shared pool of
+    worker processes and caches keyed by file contents.
+
+    Parameters
+    ==========
+    workers : integer
+        number of worker processes; defaults to the number of CPUs
+
+    max_records : integer
+        number of parsed files to keep in the cache
+
+    max_results : integer
+        number of job results to keep in the cache
+    """
+    def __init__(self, workers=None, max_records=5000, max_results=100):
+        self.pool = multiprocessing.Pool(workers)
+        self.max_records = max_records
+        self.max_results = max_results
+        self.records = OrderedDict()  # (digest, freqs) -> THFRecord
+        self.results = OrderedDict()  # job key -> result
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _cache(self, cache, key, value, max_size):
+        with self.lock:
+            cache[key] = value
+            while len(cache) > max_size:
+                cache.popitem(last=False)  # drop the oldest entry
+
+    def _lookup(self, cache, key):
+        with self.lock:
+            return cache.get(key)
+
+    def read_records(self, selected_dir, freqs=None):
+        """
+        Hashes every ``.thf`` file in the selected directory and parses the
+        ones that are not in the cache yet.
+
+        Returns
+        =======
+        records : list of THFRecord
+
+        digests : list of strings
+            content hash of each record
+
+        skipped : list of [path, reason] pairs
+            files that cannot be read
+        """
+        paths = process_THF_file.get_all_file_paths(selected_dir)
+        key_freqs = None if freqs is None else tuple(sorted(freqs))
+
+        hashed = []
+        skipped = []
+        for path, digest, reason in self.pool.map(_hash_worker, paths):
+            if digest is None:
+                skipped.append([path, reason])
+            else:
+                hashed.append((path, digest))
+
+        # Parse each missing file once, even if it is in the lot twice
+        missing = OrderedDict()
+        for path, digest in hashed:
+            if self._lookup(self.records, (digest, key_freqs)) is None:
+                missing.setdefault(digest, path)
+
+        parsed = {}
+        jobs = [(path, freqs) for path in missing.values()]
+        for path, record, reason in self.pool.map(_read_worker, jobs):
+            if record is not None:
+                parsed[path] = record
+        for digest, path in missing.items():
+            if path in parsed:
+                self._cache(self.records, (digest, key_freqs), parsed[path],
+                            self.max_records)
+
+        records = []
+        digests = []
+        for path, digest in hashed:
+            record = self._lookup(self.records, (digest, key_freqs))
+            if record is None:
+                skipped.append(
+                    [path, process_THF_file.try_read_THF_file(path, freqs)[1]])
+                continue
+            records.append(record._replace(path=path))
+            digests.append(digest)
+
+        return records, digests, skipped
+
+    def run_job(self, job):
+        """
+        Runs one job (see the module docstring) and returns its result as a
+        dictionary that can be serialized to JSON.  Raises ValueError for a
+        bad job.
+        """
+        path, output, freqs, plot_avg, rules_text = _check_job(job)
+        rules = process_THF_file.parse_spec_rules(rules_text)
+
+        records, digests, skipped = self.read_records(path, freqs)
+
+        # Files are named by their path in the lot, since two subfolders can
+        # hold files with the same name.  The same file contents under the
+        # same names give the same answer.
+        names = [os.path.relpath(record.path, path).replace('\\', '/')
+                 for record in records]
+        key = json.dumps(
+            [output, freqs, plot_avg, rules_text,
+             [list(pair) for pair in zip(names, digests)]])
+        result = self._lookup(self.results, key)
+        if result is None:
+            if output == 'metrics':
+                result = _metrics(records, rules)
+            elif output == 'export':
+                result = {'rows': list(
+                    process_THF_file.iter_output_data(records, plot_avg))}
+            else:
+                result = {'images': OrderedDict(
+                    (name, _render_png(record, plot_avg))
+                    for name, record in zip(names, records))}
+            self._cache(self.results, key, result, self.max_results)
+
+        result = dict(result)
+        result['paths'] = [record.path for record in records]
+        result['hashes'] = digests
+        result['skipped'] = skipped
+        return result
+
+    def serve(self, port=8080, host='localhost'):
+        """
+        Serves jobs over HTTP until interrupted.
+        """
+        server = self.make_server(port, host)
+        print('Serving on http://%s:%d/jobs' % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.close()
+
+    def make_server(self, port=8080, host='localhost'):
+        """
+        Returns an HTTP server for this service (use port 0 to pick a free
+        port).
+        """
+        service = self
+
+        class Handler(_JobHandler):
+            pass
+        Handler.service = service
+
+        return _ThreadingHTTPServer((host, port), Handler)
+
+
+class _JobHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _reply(self, status, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '':
+            return self._reply(404, {'error': 'Not found: %s' % self.path})
+        self._reply(200, {'records': len(self.service.records),
+                          'results': len(self.service.results)})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._reply(404, {'error': 'Not found: %s' % self.path})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            result = self.service.run_job(job)
+        except ValueError as error:  # includes bad JSON
+            return self._reply(400, {'error': str(error)})
+        except Exception as error:  # answer instead of dropping the request
+            return self._reply(500, {'error': '%s: %s' % (
+                type(error).__name__, error)})
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        pass  # keep the console quiet
+
+
+def _check_job(job):
+    """
+    Checks the fields of one job (see the module docstring) and raises
+    ValueError if any of them is bad.
+
+    Returns
+    =======
+    path, output, freqs, plot_avg, rules
+        the job fields, with their defaults filled in
+    """
+    if not isinstance(job, dict) or 'path' not in job:
+        raise ValueError('A job needs a "path".')
+
+    path = job['path']
+    if not isinstance(path, basestring) or not os.path.exists(path):
+        raise ValueError('"path" must be an existing folder, archive, or '
+                         'MTF store: %s' % (path,))
+
+    output = job.get('output', 'metrics')
+    if output not in _OUTPUTS:
+        raise ValueError('"output" must be one of %s.' % ', '.join(
+            _OUTPUTS))
+
+    freqs = job.get('freqs')
+    if freqs is not None:
+        if not isinstance(freqs, list) or not all(
+                isinstance(freq, numbers.Real) and
+                not isinstance(freq, bool) for freq in freqs):
+            raise ValueError('"freqs" must be a list of numbers.')
+        freqs = [float(freq) for freq in freqs]
+
+    plot_avg = job.get('plot_avg', False)
+    if not isinstance(plot_avg, bool):
+        raise ValueError('"plot_avg" must be true or false.')
+
+    rules = job.get('rules') or ''
+    if not isinstance(rules, basestring):
+        raise ValueError('"rules" must be a string.')
+
+    return path, output, freqs, plot_avg, rules
+
+
+def _metrics(records, rules):
+    """
+    Peak MTF and best focus (the defocus position of the peak) for every
+    file, orientation, and frequency, plus the spec verdicts.
+    """
+    files = []
+    for record in records:
+        metrics = {'freqs': record.horz[:, 0].tolist()}
+        for name, data in (('horz', record.horz[:, 1:]),
+                           ('vert', record.vert[:, 1:]),
+                           ('avg', (record.horz[:, 1:] +
+                                    record.vert[:, 1:])/2)):
+            best = data.argmax(axis=1)
+            metrics[name + '_peak'] = data.max(axis=1).tolist()
+            metrics[name + '_best_focus'] = record.defocus[best].tolist()
+        files.append(metrics)
+
+    result = {'files': files}
+    if rules and records:
+        stack = process_THF_file.stack_records(records)
+        verdicts, passed, lot_yield = process_THF_file.evaluate_specs(
+            stack, rules)
+        result['passed'] = passed.tolist()
+        result['yield'] = float(lot_yield)
+    return result
+
+
+def _render_png(record, plot_avg):
+    """
+    Plots the through-focus MTF of one record, like ``plot_one_THF_file``,
+    and returns it as a base64-encoded PNG.
+    """
+    figure = Figure(figsize=(6, 4.5))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot(111)
+
+    name = os.path.basename(record.path)[:-4]
+    for n, freq in enumerate(record.horz[:, 0]):
+        color = 'C%d' % (n % 10)
+        if plot_avg:
+            ax.plot(record.defocus, (record.horz[n, 1:] +
+                                     record.vert[n, 1:])/2,
+                    '.-', linewidth=1, c=color, label='avg at %g' % freq)
+        else:
+            ax.plot(record.defocus, record.horz[n, 1:], '.-', linewidth=1,
+                    c=color, label='horz at %g' % freq)
+            ax.plot(record.defocus, record.vert[n, 1:], '.:', linewidth=1,
+                    c=color, label='vert at %g' % freq)
+
+    ax.set_title(name, fontsize=12, fontweight='bold')
+    ax.set_ylim((0, 100))
+    ax.set_xlabel('defocus position (um)')
+    ax.set_ylabel('% MTF')
+    if len(record.horz) <= 10:
+        ax.legend(fontsize=8)
+
+    buf = io.BytesIO()
+    figure.savefig(buf, format='png')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def request_job(url, **job):
+    """
+    Posts one job to a running service and returns the decoded answer.
+
+    Parameters
+    ==========
+    url : string
+        e.g. ``http://localhost:8080/jobs``
+
+    **job
+        the job fields, e.g. ``path``, ``output``, ``freqs``, ``plot_avg``,
+        and ``rules``
+
+    Returns
+    =======
+    result : dictionary
+        Raises ValueError with the service's message if the job fails.
+    """
+    request = Request(url, json.dumps(job).encode('utf-8'),
+                      {'Content-Type': 'application/json'})
+    try:
+        response = urlopen(request)
+    except HTTPError as error:
+        raise ValueError(json.loads(error.read().decode('utf-8'))['error'])
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve batch jobs on .thf files over local HTTP.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    args = parser.parse_args()
+
+    THFService(args.workers).serve(args.port)
+
+
+if __name__ == '__main__':
+    main()
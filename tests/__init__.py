@@ -0,0 +1,12 @@
+"""
+Tests for ``process_THF_file``, against the sample files in ``data/``.  Run
+them from the top folder with::
+
+    python -m unittest discover -s tests -t .
+"""
+import os
+import matplotlib
+matplotlib.use('Agg')  # no windows while testing
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
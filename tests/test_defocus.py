@@ -0,0 +1,90 @@
+import unittest
+import numpy as np
+from tests import DATA_DIR
+import process_THF_file
+
+
+def _make_stack(defocus, values):
+    """
+    A stack of files with one frequency, the given (files x planes)
+    NaN-padded defocus positions, and the same MTF "values" in horz and vert.
+    """
+    defocus = np.asarray(defocus, dtype=float)
+    values = np.asarray(values, dtype=float)[:, np.newaxis, :]
+    n_files, n_planes = defocus.shape
+    return process_THF_file.THFStack(
+        ['file%d.thf' % idx for idx in range(n_files)],
+        np.full((n_files, 1), 50.0),
+        defocus,
+        values,
+        values.copy(),
+        np.zeros((n_files, n_planes, 2)),
+        {})
+
+
+class CommonDefocusGridTest(unittest.TestCase):
+    def test_keeps_every_plane_of_every_file(self):
+        stack = process_THF_file.stack_THF_files(DATA_DIR)
+        grid = process_THF_file.common_defocus_grid(stack)
+
+        positions = stack.defocus[~np.isnan(stack.defocus)]
+        distance = np.abs(positions[:, np.newaxis] - grid).min(axis=1)
+        self.assertTrue((distance < 0.02).all())
+        self.assertTrue((np.diff(grid) > 0).all())
+
+    def test_merges_jittered_positions(self):
+        stack = _make_stack(
+            [[0.0, 10.0, 20.0], [0.01, 10.01, 20.01]], np.ones((2, 3)))
+        grid = process_THF_file.common_defocus_grid(stack)
+        np.testing.assert_allclose(grid, [0.0, 10.0, 20.0])
+
+
+class ResampleDefocusTest(unittest.TestCase):
+    def test_matches_np_interp(self):
+        rng = np.random.RandomState(0)
+        defocus = np.full((3, 6), np.nan)
+        defocus[0] = np.cumsum(rng.uniform(5, 15, 6)) - 40
+        defocus[1, :4] = np.cumsum(rng.uniform(5, 15, 4)) - 20
+        defocus[2, :5] = np.cumsum(rng.uniform(1, 30, 5)) - 60
+        values = rng.uniform(0, 100, (3, 6))
+        stack = _make_stack(defocus, values)
+
+        grid = np.linspace(-70, 80, 61)
+        resampled = process_THF_file.resample_defocus(stack, grid)
+
+        # Points just past the ends (within a tenth of the finest spacing)
+        # take the value of the end plane, like np.interp does
+        with np.errstate(invalid='ignore'):
+            tolerance = np.nanmin(np.diff(defocus, axis=1))/10.0
+        for idx in range(3):
+            n_planes = np.count_nonzero(~np.isnan(defocus[idx]))
+            x = defocus[idx, :n_planes]
+            inside = (grid >= x[0] - tolerance) & (grid <= x[-1] + tolerance)
+            np.testing.assert_allclose(
+                resampled.horz[idx, 0, inside],
+                np.interp(grid[inside], x, values[idx, :n_planes]))
+            self.assertTrue(np.isnan(resampled.horz[idx, 0, ~inside]).all())
+
+    def test_jittered_end_planes_stay_inside(self):
+        stack = _make_stack(
+            [[-50.0, 50.0, 150.0], [-50.01, 50.0, 150.01]],
+            [[10.0, 20.0, 30.0], [40.0, 50.0, 60.0]])
+        resampled = process_THF_file.resample_defocus(stack)
+
+        self.assertFalse(np.isnan(resampled.horz).any())
+        np.testing.assert_allclose(resampled.horz[0, 0, [0, -1]], [10, 30])
+
+    def test_field_groups_use_their_own_grids(self):
+        stack = process_THF_file.stack_THF_files(DATA_DIR)
+        groups = process_THF_file.field_group_stats(stack)
+
+        np.testing.assert_allclose(groups.angles, [0, 14])
+        for idx in range(len(groups.angles)):
+            n_planes = np.count_nonzero(~np.isnan(groups.defocus[idx]))
+            self.assertEqual(n_planes, 21)
+            self.assertFalse(
+                np.isnan(groups.mean[idx, :, :n_planes]).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import numpy as np
+from tests import DATA_DIR
+import process_THF_file
+
+
+RULES = (
+    'avg 30 85; horz 20 30 -600 -300; vert 10 20 0 100; '
+    'horz 40 10 -710 -230; avg 200 10')
+
+
+def _rule_MTF(record, rule):
+    """
+    The MTF of one record at a rule's frequency, or None without it.
+    """
+    rows = record.horz[:, 0] == rule.freq
+    if not rows.any():
+        return None
+    horz, vert = record.horz[rows, 1:][0], record.vert[rows, 1:][0]
+    return {'horz': horz, 'vert': vert, 'avg': (horz + vert)/2.0}[
+        rule.orientation]
+
+
+def _check_rule(record, rule):
+    """
+    One file against one rule, plane by plane.
+    """
+    MTF = _rule_MTF(record, rule)
+    if MTF is None:
+        return False
+    if rule.defocus_min is None:
+        return any(value >= rule.min_MTF for value in MTF)
+
+    in_range = [
+        value for value, position in zip(MTF, record.defocus)
+        if rule.defocus_min <= position <= rule.defocus_max]
+    return bool(in_range) and all(
+        value >= rule.min_MTF for value in in_range)
+
+
+class ParseSpecRulesTest(unittest.TestCase):
+    def test_parses_rules(self):
+        rules = process_THF_file.parse_spec_rules(
+            ' avg 52 40 -20 20;; horz 104 25 ')
+        self.assertEqual(rules, [
+            process_THF_file.SpecRule('avg', 52, 40, -20, 20),
+            process_THF_file.SpecRule('horz', 104, 25, None, None)])
+
+    def test_rejects_bad_rules(self):
+        for text in ('diag 52 40', 'avg 52', 'avg 52 40 -20', 'avg a b'):
+            self.assertRaises(
+                ValueError, process_THF_file.parse_spec_rules, text)
+
+
+class EvaluateSpecsTest(unittest.TestCase):
+    def test_matches_file_by_file(self):
+        stack = process_THF_file.stack_THF_files(DATA_DIR)
+        rules = process_THF_file.parse_spec_rules(RULES)
+        verdicts, passed, lot_yield = process_THF_file.evaluate_specs(
+            stack, rules)
+
+        expected = np.array([
+            [_check_rule(process_THF_file.read_THF_file(path), rule)
+             for rule in rules]
+            for path in stack.paths])
+        np.testing.assert_array_equal(verdicts, expected)
+        np.testing.assert_array_equal(passed, expected.all(axis=1))
+        self.assertEqual(lot_yield, expected.all(axis=1).mean())
+
+        # The rules must tell the files apart to test anything
+        self.assertTrue(expected[:, :-1].any(axis=0).all())
+        self.assertFalse(expected[:, :-1].all(axis=0).any())
+        self.assertFalse(expected[:, -1].any())
+
+
+class BestFocusCurvesTest(unittest.TestCase):
+    def _check(self, ref_freq, orientation):
+        stack = process_THF_file.stack_THF_files(DATA_DIR)
+        curves = process_THF_file.best_focus_curves(
+            stack, orientation, ref_freq=ref_freq, offsets=(0, 40))
+
+        for idx, path in enumerate(stack.paths):
+            record = process_THF_file.read_THF_file(path)
+            horz, vert = record.horz[:, 1:], record.vert[:, 1:]
+            data = {'horz': horz, 'vert': vert, 'avg': (horz + vert)/2.0}[
+                orientation]
+            if ref_freq is None:
+                peak = data.mean(axis=0).argmax()
+            else:
+                peak = data[record.horz[:, 0] == ref_freq][0].argmax()
+
+            self.assertEqual(curves.best_focus[idx], record.defocus[peak])
+            np.testing.assert_allclose(curves.MTF[idx, 0], data[:, peak])
+
+            # 40 um past best focus is the nearest plane, if in range
+            position = record.defocus[peak] + 40
+            if position > record.defocus[-1]:
+                self.assertTrue(np.isnan(curves.MTF[idx, 1]).all())
+            else:
+                nearest = np.abs(record.defocus - position).argmin()
+                np.testing.assert_allclose(
+                    curves.MTF[idx, 1], data[:, nearest])
+
+    def test_mean_over_freqs(self):
+        self._check(None, 'avg')
+
+    def test_ref_freq(self):
+        self._check(30, 'horz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import numpy as np
+from tests import DATA_DIR
+import process_THF_file
+
+
+def _names(paths):
+    return [os.path.basename(path) for path in paths]
+
+
+def _assert_same_records(test, records, expected):
+    """
+    Folders are listed in no particular order, so records are matched by
+    their file names.
+    """
+    by_name = dict(zip(_names(record.path for record in records), records))
+    test.assertEqual(sorted(by_name), sorted(_names(
+        record.path for record in expected)))
+    for other in expected:
+        record = by_name[os.path.basename(other.path)]
+        for field in ('defocus', 'horz', 'vert', 'intensity'):
+            np.testing.assert_array_equal(
+                getattr(record, field), getattr(other, field))
+        test.assertEqual(record.header, other.header)
+
+
+def _assert_same_stack(test, stack, expected, **tolerance):
+    test.assertEqual(list(stack.paths), list(expected.paths))
+    for field in ('freqs', 'defocus', 'horz', 'vert', 'intensity'):
+        np.testing.assert_allclose(
+            np.asarray(getattr(stack, field), dtype=float),
+            getattr(expected, field), equal_nan=True, **tolerance)
+
+
+class StackingTest(unittest.TestCase):
+    """
+    Builds folders, a zip and a tar from the files in ``data/``.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.names = sorted(
+            name for name in os.listdir(DATA_DIR) if name.endswith('.thf'))
+
+        def folder(name, sources=()):
+            path = os.path.join(cls.tmp_dir, name)
+            os.mkdir(path)
+            for source in sources:
+                shutil.copy(os.path.join(DATA_DIR, source), path)
+            return path
+
+        cls.lot = folder('lot', cls.names)
+
+        cls.zip_path = os.path.join(cls.tmp_dir, 'lot.zip')
+        with zipfile.ZipFile(cls.zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name in cls.names:
+                z.write(os.path.join(DATA_DIR, name), name)
+
+        cls.tar_path = os.path.join(cls.tmp_dir, 'lot.tar.gz')
+        with tarfile.open(cls.tar_path, 'w:gz') as tar:
+            for name in cls.names:
+                tar.add(os.path.join(DATA_DIR, name), name)
+
+        with open(os.path.join(DATA_DIR, cls.names[0])) as infile:
+            cls.text = infile.read()
+
+        # Bad files among good ones: not a .thf file at all, too short, and
+        # cut off in the middle of the MTF tables
+        cls.bad = folder('bad', cls.names[:2])
+        for name, text in (('00junk.thf', 'not a through-focus file\n' * 40),
+                           ('00tiny.thf', 'x'),
+                           ('00truncated.thf', cls.text[:len(cls.text)//2])):
+            with open(os.path.join(cls.bad, name), 'w') as outfile:
+                outfile.write(text)
+
+        cls.all_bad = folder('all_bad')
+        shutil.copy(os.path.join(cls.bad, '00junk.thf'), cls.all_bad)
+
+        # The same measurement saved twice under different names
+        cls.dup = folder('dup', cls.names)
+        shutil.copy(os.path.join(DATA_DIR, cls.names[0]),
+                    os.path.join(cls.dup, 'zz copy.thf'))
+
+        # A file with fewer frequencies than the others
+        cls.mixed = folder('mixed', cls.names[1:])
+        with open(os.path.join(cls.mixed, '00 few freqs.thf'), 'w') as f:
+            f.write(cls._drop_freqs(cls.text, 60))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    @staticmethod
+    def _drop_freqs(text, max_freq):
+        """
+        Drops the MTF table rows above "max_freq" from a ``.thf`` file.  Only
+        the table rows start with a number and have more than two columns.
+        """
+        kept = []
+        for line in text.splitlines(True):
+            fields = line.split('\t')
+            if len(fields) > 2:
+                try:
+                    if float(fields[0]) > max_freq:
+                        continue
+                except ValueError:
+                    pass
+            kept.append(line)
+        return ''.join(kept)
+
+    def test_workers_match_serial(self):
+        serial = process_THF_file.stack_THF_files(self.lot)
+        shared = process_THF_file.stack_THF_files(self.lot, workers=2)
+        _assert_same_stack(self, shared, serial)
+
+        single = process_THF_file.stack_THF_files(
+            self.lot, dtype=np.float32, workers=2)
+        self.assertEqual(single.horz.dtype, np.float32)
+        _assert_same_stack(self, single, serial, atol=1e-4)
+
+    def test_archives_match_folder(self):
+        expected = list(process_THF_file.iter_thf(self.lot))
+        self.assertEqual(len(expected), len(self.names))
+        for path in (self.zip_path, self.tar_path):
+            _assert_same_records(
+                self, list(process_THF_file.iter_thf(path)), expected)
+            _assert_same_records(
+                self, list(process_THF_file.iter_thf(path, workers=2)),
+                expected)
+
+    def test_quarantine(self):
+        for workers in (None, 2):
+            quarantine = []
+            stack = process_THF_file.stack_THF_files(
+                self.bad, quarantine=quarantine, workers=workers)
+            self.assertEqual(sorted(_names(stack.paths)), self.names[:2])
+            self.assertEqual(
+                sorted(_names(path for path, reason in quarantine)),
+                ['00junk.thf', '00tiny.thf', '00truncated.thf'])
+            self.assertTrue(all(reason for path, reason in quarantine))
+
+        self.assertRaises(ValueError, list, process_THF_file.iter_thf(
+            self.bad))
+        for workers in (None, 2):
+            self.assertRaises(
+                process_THF_file.NoTHFFilesError,
+                process_THF_file.stack_THF_files, self.all_bad,
+                quarantine=[], workers=workers)
+
+    def test_duplicates(self):
+        for workers in (None, 2):
+            duplicates = []
+            stack = process_THF_file.stack_THF_files(
+                self.dup, duplicates=duplicates, workers=workers)
+            # Either copy may be listed first; the other is the duplicate
+            self.assertEqual(len(stack.paths), len(self.names))
+            self.assertEqual(len(duplicates), 1)
+            pair = _names(duplicates[0])
+            self.assertEqual(sorted(pair), [self.names[0], 'zz copy.thf'])
+            self.assertEqual(
+                sorted(_names(stack.paths) + pair[:1]),
+                sorted(self.names + ['zz copy.thf']))
+
+    def test_mixed_sizes(self):
+        serial = process_THF_file.stack_THF_files(self.mixed)
+        shared = process_THF_file.stack_THF_files(self.mixed, workers=2)
+        _assert_same_stack(self, shared, serial)
+
+        few = _names(serial.paths).index('00 few freqs.thf')
+        n_freqs = np.count_nonzero(~np.isnan(serial.freqs), axis=1)
+        self.assertEqual(n_freqs[few], 61)
+        self.assertEqual(sorted(n_freqs), [61, 65, 65, 65])
+        self.assertTrue(np.isnan(serial.horz[few, 61:]).all())
+
+    def test_store_round_trip(self):
+        store_dir = os.path.join(self.tmp_dir, 'store')
+        process_THF_file.write_MTF_store(self.lot, store_dir, workers=2)
+
+        for plot_avg in (True, False):
+            expected = list(process_THF_file.iter_output_data(
+                process_THF_file.iter_thf(self.lot), plot_avg))
+            rows = list(process_THF_file.iter_output_data(
+                process_THF_file.iter_thf(store_dir), plot_avg))
+            self.assertEqual(rows, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()